@@ -27,6 +27,10 @@ import logging
 import os
 
 from . import commands
+from . import daemon
+from . import engine
+from . import mirror
+from . import tracing
 from . import utils
 
 
@@ -40,6 +44,10 @@ DEFAULT_TEMPLATE = 'openstack-puppet-modules.template'
 class Config(object):
     def __init__(self):
         self.verbose = False
+        self.mirror_dir = mirror.MIRROR_DIR
+        self.fetch = 'full'
+        self.host_jobs = engine.REMOTE_JOBS
+        self.daemon_socket = daemon.SOCKET
 
 pass_config = click.make_pass_decorator(Config, ensure=True)
 
@@ -47,38 +55,109 @@ pass_config = click.make_pass_decorator(Config, ensure=True)
 @click.group()
 @click.option('--log', default='/var/tmp/bade.log', help='Path to logfile')
 @click.option('--verbose', is_flag=True, help='Enable verbose mode')
+@click.option('--mirror-dir', default=mirror.MIRROR_DIR,
+              help='Path to directory with local mirrors of upstream repos.')
+@click.option('--no-mirror', is_flag=True,
+              help='Fetch modules directly from upstream repos.')
+@click.option('--fetch', default='full',
+              type=click.Choice(['full', 'shallow', 'partial']),
+              help='Fetch full history of upstream repos, just pinned '
+                   'commits (shallow) or pinned commits without blobs '
+                   '(partial).')
+@click.option('--host-jobs', default=engine.REMOTE_JOBS, type=int,
+              help='Maximal number of concurrent fetches from one upstream '
+                   'host (unless limited in ~/.bade/hosts.json).')
+@click.option('--trace', default=None,
+              help='Path to file to which timing spans of commands, module '
+                   'steps and subprocesses are written.')
+@click.option('--profile', is_flag=True,
+              help='Print summary of slowest modules and git operations.')
+@click.option('--daemon-socket', default=daemon.SOCKET,
+              help='Path to unix socket of bade daemon.')
+@click.option('--no-daemon', is_flag=True,
+              help='Run command in this process even if bade daemon '
+                   'is running.')
 @pass_config
-def bade(config, log, verbose):
-    # setup logging
-    handler = logging.FileHandler(filename=log, mode='a')
+def bade(config, log, verbose, mirror_dir, no_mirror, fetch, host_jobs,
+         trace, profile, daemon_socket, no_daemon):
+    setup_logging(log, verbose)
+    # setup config
+    config.verbose = verbose
+    config.mirror_dir = None if no_mirror else mirror_dir
+    config.fetch = fetch
+    config.host_jobs = host_jobs
+    config.daemon_socket = None if no_daemon else daemon_socket
+    # setup tracing
+    if trace or profile:
+        # spans are collected only in this process
+        config.daemon_socket = None
+        tracing.enable(trace)
+        click.get_current_context().call_on_close(report_trace)
+
+
+def setup_logging(log, verbose):
+    """Attaches handler writing to 'log' file to bade logger unless it is
+    already attached. The file is opened on first logged record.
+    """
+    logger = logging.getLogger('bade')
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+    path = os.path.abspath(log)
+    for handler in logger.handlers:
+        if getattr(handler, 'baseFilename', None) == path:
+            return
+    handler = logging.FileHandler(filename=path, mode='a', delay=True)
     handler.setFormatter(
         logging.Formatter(
             '%(asctime)s [%(levelname)s]: %(message)s',
             '%Y-%m-%d %H:%M:%S'
         )
     )
-    logger = logging.getLogger('bade')
     logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
-    # setup config
-    config.verbose = verbose
+
+
+def report_trace():
+    """Prints summary of collected trace spans."""
+    tracer = tracing.disable()
+    if tracer:
+        click.echo(tracer.summary(), err=True)
 
 
 @bade.command('init')
 @click.option('--commit', is_flag=True,
               help='Create commit after initialization.')
+@click.option('--jobs', default=1, type=int,
+              help='Number of modules fetched in parallel.')
+@click.option('--force', is_flag=True,
+              help='Reinitialize also modules which are up to date.')
+@click.option('--update-lock', is_flag=True,
+              help='Resolve modules pinned to branch names again instead '
+                   'of using commits recorded in Puppetfile.lock.')
+@click.option('--no-checkout', is_flag=True,
+              help='Create the commit without updating index and working '
+                   'tree (requires --commit).')
 @click.argument('repo', default='.')
 @pass_config
-def init_wrapper(config, repo, commit):
+def init_wrapper(config, repo, commit, jobs, force, update_lock, no_checkout):
     """Creates git subtree hierarchy from Puppetfile located in cwd or
     from repo given by argument."""
+    if no_checkout and not commit:
+        raise click.UsageError('Option --no-checkout requires --commit.')
+    code = None
     try:
         utils.shout(
             'Initializing git subtree hierarchy for {0}'.format(repo),
             verbose=config.verbose,
             level='info'
         )
-        commands.init.command(config, repo, commit)
+        code = daemon.forward(config, 'init', repo, commit=commit, jobs=jobs,
+                              force=force, update_lock=update_lock,
+                              checkout=not no_checkout)
+        if code is None:
+            with tracing.span('command', 'init', repo=repo):
+                commands.load('init').command(
+                    config, repo, commit, jobs=jobs, force=force,
+                    update_lock=update_lock, checkout=not no_checkout
+                )
     except utils.ExecutionError as ex:
         utils.shout(ex, verbose=True, level='error')
         utils.shout(
@@ -91,23 +170,76 @@ def init_wrapper(config, repo, commit):
         utils.shout(ex, verbose=True, level='error')
         if config.verbose:
             raise
+    if code:
+        # job run by daemon failed
+        click.get_current_context().exit(code)
 
 
 @bade.command('update')
-@click.option('--module', required=True,
+@click.option('--module', default=None,
               help='Module which should be updated')
-@click.option('--hash', required=True,
+@click.option('--hash', default=None,
               help='Commit hash from upstream GIT repo to which module will '
                    'be updated.')
+@click.option('--manifest', default=None, type=click.File('r'),
+              help='Path to file with "<module> <commit hash>" pairs, one '
+                   'per line, of modules which should be updated. Use "-" '
+                   'to read pairs from stdin.')
+@click.option('--puppetfile', default=None,
+              help='Path to Puppetfile to which modules should be updated.')
+@click.option('--jobs', default=1, type=int,
+              help='Number of modules fetched in parallel.')
 @click.option('--commit', is_flag=True,
               help='Create commit after update.')
+@click.option('--branches', default=None,
+              help='Comma separated base branches which should be updated '
+                   'and committed instead of the current branch.')
+@click.option('--no-checkout', is_flag=True,
+              help='Create the commit without updating index and working '
+                   'tree (requires --commit).')
 @click.argument('repo', default='.')
 @pass_config
-def sync_wrapper(config, repo, module, hash, commit):
+def sync_wrapper(config, repo, module, hash, manifest, puppetfile, jobs,
+                 commit, branches, no_checkout):
     """Updates git subtree hierarchy from Puppetfile located in cwd or
     from repo given by argument."""
+    if no_checkout and not commit:
+        raise click.UsageError('Option --no-checkout requires --commit.')
+    if branches:
+        branches = [branch.strip() for branch in branches.split(',')
+                    if branch.strip()]
+        if not commit:
+            raise click.UsageError(
+                'Option --branches requires --commit, branches which are '
+                'not checked out can be updated only by commits.'
+            )
+    if len([i for i in (module or hash, manifest, puppetfile) if i]) != 1:
+        raise click.UsageError(
+            'Use either --module with --hash, --manifest or --puppetfile.'
+        )
+    if (module or hash) and not (module and hash):
+        raise click.UsageError('Options --module and --hash go together.')
+    code = None
     try:
-        commands.update.command(config, repo, module, hash, commit)
+        if manifest:
+            updates = commands.load('update').load_manifest(manifest)
+        elif puppetfile:
+            current = utils.PuppetFile(repo)
+            current.load()
+            target = utils.PuppetFile(repo)
+            target.load(puppetfile)
+            updates = commands.load('update').converge(current, target)
+        else:
+            updates = [(module, hash)]
+        code = daemon.forward(config, 'update', repo, updates=updates,
+                              commit=commit, jobs=jobs, branches=branches,
+                              checkout=not no_checkout)
+        if code is None:
+            with tracing.span('command', 'update', repo=repo, module=module):
+                commands.load('update').command(
+                    config, repo, updates, commit, jobs=jobs,
+                    branches=branches, checkout=not no_checkout
+                )
     except utils.ExecutionError as ex:
         utils.shout(ex, verbose=True, level='error')
         utils.shout(
@@ -120,12 +252,31 @@ def sync_wrapper(config, repo, module, hash, commit):
         utils.shout(ex, verbose=True, level='error')
         if config.verbose:
             raise
+    if code:
+        # job run by daemon failed
+        click.get_current_context().exit(code)
+
+
+def parse_targets(ctx, param, value):
+    """Returns list of (template, output, release) tuples of --target
+    options.
+    """
+    targets = []
+    for target in value:
+        parts = target.split(':')
+        if len(parts) != 3 or not all(parts):
+            raise click.BadParameter(
+                'Target has to be in format template:output:release, '
+                'not "{0}".'.format(target)
+            )
+        targets.append((parts[0], os.path.abspath(parts[1]), parts[2]))
+    return targets
 
 
 @bade.command('spec')
 @click.option('--version', required=True,
               help='Version for a tag.')
-@click.option('--release', required=True,
+@click.option('--release', default=None,
               help='Release for a tag.')
 @click.option('--old', required=True,
               help='Path to old SPEC file.')
@@ -133,22 +284,37 @@ def sync_wrapper(config, repo, module, hash, commit):
                help='Path to output SPEC file.')
 @click.option('--template', default=DEFAULT_TEMPLATE,
                help='Path to template from which SPEC is generated.')
+@click.option('--target', multiple=True, callback=parse_targets,
+              help='Generate SPEC file from template to output for release '
+                   'given as "template:output:release" instead of using '
+                   '--template, --output and --release. Can be repeated.')
+@click.option('--tarballs', default=None,
+              help='Path to directory in which source tarball of each '
+                   'module is created.')
+@click.option('--jobs', default=4, type=int,
+              help='Number of tarballs created in parallel.')
 @click.argument('repo', default='.')
 @pass_config
 def sync_wrapper(config, repo, version, release, old, output,
-                 template):
+                 template, target, tarballs, jobs):
     """Generates SPEC file from Puppetfile and tags repo appropriately.
     """
+    if not target and not release:
+        raise click.UsageError('Use either --release or --target.')
+    code = None
     try:
-        utils.shout(
-            'Generating SPEC file {0} from template {1}'.format(
-                output, template
-            ),
-            verbose=config.verbose,
-            level='info'
-        )
-        commands.spec.command(config, repo, version, release, old,
-                              output, template)
+        code = daemon.forward(config, 'spec', repo, version=version,
+                              release=release, old=os.path.abspath(old),
+                              output=os.path.abspath(output),
+                              template=template, targets=target,
+                              tarballs=tarballs and os.path.abspath(tarballs),
+                              jobs=jobs)
+        if code is None:
+            with tracing.span('command', 'spec', repo=repo):
+                commands.load('spec').command(
+                    config, repo, version, release, old, output, template,
+                    targets=target, tarballs=tarballs, jobs=jobs
+                )
     except utils.ExecutionError as ex:
         utils.shout(ex, verbose=True, level='error')
         utils.shout(
@@ -161,6 +327,9 @@ def sync_wrapper(config, repo, version, release, old, output,
         utils.shout(ex, verbose=True, level='error')
         if config.verbose:
             raise
+    if code:
+        # job run by daemon failed
+        click.get_current_context().exit(code)
 
 
 @bade.command('clean')
@@ -169,18 +338,54 @@ def sync_wrapper(config, repo, version, release, old, output,
 @click.argument('repo', default='.')
 @pass_config
 def clean_wrapper(config, repo, branch):
-    """Removes module branches which have been created to synchronize base
+    """Removes module refs (and module branches and remotes created by
+    older versions of bade) which have been created to synchronize base
     branch.
     """
     if not branch:
         branch = utils.get_current_branch(repo)
+    code = None
     try:
         utils.shout(
-            'Removing module branches for base branch {0}'.format(branch),
+            'Removing module refs for base branch {0}'.format(branch),
             verbose=config.verbose,
             level='info'
         )
-        commands.clean.command(config, repo, branch)
+        code = daemon.forward(config, 'clean', repo, branch=branch)
+        if code is None:
+            with tracing.span('command', 'clean', repo=repo, branch=branch):
+                commands.load('clean').command(config, repo, branch)
+    except utils.ExecutionError as ex:
+        utils.shout(ex, verbose=True, level='error')
+        utils.shout(
+            '====== stdout ======\n{stdout}\n'
+            '====== stderr ======\n{stderr}'.format(**ex.__dict__),
+            verbose=config.verbose,
+            level=None,
+        )
+    except Exception as ex:
+        utils.shout(ex, verbose=True, level='error')
+        if config.verbose:
+            raise
+    if code:
+        # job run by daemon failed
+        click.get_current_context().exit(code)
+
+
+@bade.command('status')
+@click.option('--worktree', is_flag=True,
+              help='Report also uncommitted changes in module directories.')
+@click.argument('repo', default='.')
+@pass_config
+def status_wrapper(config, repo, worktree):
+    """Reports modules whose directories in HEAD do not match commits
+    pinned in Puppetfile. Exits with status 1 if any module does not match.
+    """
+    try:
+        with tracing.span('command', 'status', repo=repo):
+            problems = commands.load('status').command(
+                config, repo, worktree=worktree
+            )
     except utils.ExecutionError as ex:
         utils.shout(ex, verbose=True, level='error')
         utils.shout(
@@ -189,10 +394,14 @@ def clean_wrapper(config, repo, branch):
             verbose=config.verbose,
             level=None,
         )
+        problems = True
     except Exception as ex:
         utils.shout(ex, verbose=True, level='error')
         if config.verbose:
             raise
+        problems = True
+    if problems:
+        click.get_current_context().exit(1)
 
 
 @bade.command('add')
@@ -203,13 +412,22 @@ def clean_wrapper(config, repo, branch):
 @click.option('--hash', required=True,
               help='Commit hash from upstream GIT repo on which module will '
                    'be initialized.')
+@click.option('--no-checkout', is_flag=True,
+              help='Create the commit without updating index and working '
+                   'tree (requires --commit).')
 @click.argument('repo', default='.')
 @pass_config
-def add_wrapper(config, repo, commit, upstream, hash):
+def add_wrapper(config, repo, commit, upstream, hash, no_checkout):
     """Adds new module to Puppetfile and synchronizes base branch accordingly.
     """
+    if no_checkout and not commit:
+        raise click.UsageError('Option --no-checkout requires --commit.')
     try:
-        commands.add.command(config, repo, commit, upstream, hash)
+        with tracing.span('command', 'add', repo=repo):
+            commands.load('add').command(
+                config, repo, commit, upstream, hash,
+                checkout=not no_checkout
+            )
     except utils.ExecutionError as ex:
         utils.shout(ex, verbose=True, level='error')
         utils.shout(
@@ -222,5 +440,27 @@ def add_wrapper(config, repo, commit, upstream, hash):
         utils.shout(ex, verbose=True, level='error')
         if config.verbose:
             raise
+
+
+@bade.command('serve')
+@pass_config
+def serve_wrapper(config):
+    """Runs bade daemon serving init, update, spec and clean commands
+    on unix socket. Other bade commands forward to the daemon automatically
+    while it is running.
+    """
+    try:
+        utils.shout(
+            'Serving bade jobs on {0}'.format(config.daemon_socket),
+            verbose=True,
+            level='info'
+        )
+        daemon.serve(config.daemon_socket or daemon.SOCKET)
+    except KeyboardInterrupt:
+        pass
+    except utils.ExecutionError as ex:
+        utils.shout(ex, verbose=True, level='error')
+
+
 if __name__ == '__main__':
     bade()
@@ -1,2 +1,11 @@
+# -*- coding: utf-8 -*-
 
-from . import init, update, spec, clean, add
+import importlib
+
+
+def load(name):
+    """Returns module of given subcommand. Subcommand modules are imported
+    on first use, so that each bade invocation imports just the code
+    of the dispatched command.
+    """
+    return importlib.import_module('.{0}'.format(name), __name__)
@@ -6,11 +6,15 @@ from .. import utils
 from . import init
 
 
-def command(config, repo, commit, upstream, commit_hash):
-    """Updates Puppetfile and base branch accordingly
+def command(config, repo, commit, upstream, commit_hash, checkout=True):
+    """Updates Puppetfile and base branch accordingly. Commit is assembled
+    in temporary index, index and working tree are updated afterwards.
+    If 'checkout' is False, the commit is assembled from HEAD (including
+    Puppetfile) and index and working tree are left untouched.
     """
-    puppetfile = utils.PuppetFile(repo)
-    puppetfile.load()
+    branch = utils.get_current_branch(repo)
+    worktree = not commit or init.uses_worktree(repo, branch, checkout)
+    tip, puppetfile, lock = init.read_branch(repo, branch, worktree=worktree)
     if len(puppetfile) and 'commit' in puppetfile.values()[0]:
         key = 'commit'
     else:
@@ -18,7 +22,6 @@ def command(config, repo, commit, upstream, commit_hash):
 
 
     # update Puppetfile
-    branch = utils.get_current_branch(repo)
     repo_name = os.path.basename(upstream)
     if '-' in repo_name:
         basename = repo_name.split('-', 1)[1].split('.', 1)[0]
@@ -31,44 +34,44 @@ def command(config, repo, commit, upstream, commit_hash):
         level='info'
     )
     puppetfile[basename] = {'git': upstream, key: commit_hash}
-    puppetfile.save()
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git stash'.format(**_locals)
-    )
 
-    # sync base branch
-    init.create_module_branch(repo, branch, basename, puppetfile[basename])
-    init.import_module_branch(repo, branch, basename)
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git checkout {branch} && '
-        'git stash apply && '
-        'git stash drop'.format(**_locals),
-        can_fail=False
-    )
-    if rc:
-        utils.shout(
-            'Failed to unstash Puppetfile changes:'
-                '\n{stdout}'.format(**_locals),
-            verbose=True,
-            level='warning'
+    def synchronize(env=None):
+        failed = init.sync_modules(
+            config, repo, branch, {basename: puppetfile[basename]},
+            [basename],
+            imported=lambda module: init.lock_module(
+                repo, branch, module, puppetfile[module], lock
+            ),
+            env=env
         )
+        if failed:
+            raise init.fetch_error(failed)
+
+    # sync base branch
+    if not commit:
+        puppetfile.save()
+        try:
+            synchronize()
+        finally:
+            lock.save()
+        return
 
-    if commit:
+    with init.temporary_index(repo, branch, tip, worktree=worktree) as env:
+        synchronize(env)
         utils.shout(
             'Generating commit',
             verbose=config.verbose,
             level='info'
         )
         status = (
-            '{basename}\\n - initial commit: {commit_hash}'
-            '\\n\\n'.format(**_locals)
+            '{basename}\n - initial commit: {commit_hash}'
+            '\n\n'.format(**_locals)
         )
-        msg = utils.COMMIT_MSG.format(status)
-        rc, stdout, stderr = utils.execute(
-            'cd {repo} && '
-            'git add {basename} --ignore-errors && '
-            'git add Puppetfile && '
-            'git commit -m $\'{msg}\''.format(**locals())
+        files = {
+            'Puppetfile': puppetfile.dumps(),
+            'Puppetfile.lock': lock.dumps(),
+        }
+        init.commit_index(
+            repo, branch, tip, env, files, utils.COMMIT_MSG.format(status),
+            [basename], worktree=worktree
         )
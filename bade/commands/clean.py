@@ -1,100 +1,179 @@
 # -*- coding: utf-8 -*-
 
-import os
-
+from .. import git
 from .. import utils
-from . import init
 
 
-def check_module_branch(repo, branch, module, info):
-    """Returns current commit hash in module branch. Module branch
-    is created according to Puppetfile if it does not exist.
+def delete_refs(repo, refs):
+    """Deletes given {ref: hash} mapping in one update-ref transaction.
+    In case the transaction fails refs are deleted one by one, so that
+    the failing ones can be told. Returns list of refs which failed to be
+    deleted.
     """
-    _locals = locals()
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} &>/dev/null && '
-        'git checkout {branch}-{module}'.format(**_locals),
+    if not refs:
+        return []
+    transaction = ''.join(
+        'delete {0} {1}\n'.format(ref, sha)
+        for ref, sha in sorted(refs.items())
+    )
+    rc, stdout, stderr = utils.run(
+        ['git', 'update-ref', '--stdin'], workdir=repo, input=transaction,
         can_fail=False
     )
-    if rc:
-        init.create_module_branch(repo, branch, module, info)
-
-    # get current state
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} &>/dev/null && '
-        'git checkout {branch}-{module} &>/dev/null && '
-        'git rev-parse HEAD && '
-        'git checkout {branch} &>/dev/null'.format(**_locals)
+    if not rc:
+        return []
+    failed = []
+    for ref, sha in sorted(refs.items()):
+        rc, stdout, stderr = utils.run(
+            ['git', 'update-ref', '-d', ref, sha], workdir=repo,
+            can_fail=False
+        )
+        if rc:
+            failed.append(ref)
+    return failed
+
+
+def partial_remotes(repo):
+    """Returns set of promisor remotes recorded by partial fetches, those
+    are named by URL of upstream repo and have no URL configured.
+    """
+    rc, stdout, stderr = utils.run(
+        ['git', 'config', '-z', '--get-regexp', r'^remote\..*\.promisor$'],
+        workdir=repo, can_fail=False
     )
-    return stdout.strip()
+    session = git.get_session(repo)
+    remotes = set()
+    for item in stdout.split('\0'):
+        if not item:
+            continue
+        key, _, value = item.partition('\n')
+        name = key[len('remote.'):-len('.promisor')]
+        if not session.config('remote.{0}.url'.format(name)):
+            remotes.add(name)
+    return remotes
+
+
+def has_missing_objects(repo):
+    """Returns True if some object reachable from any ref is not present
+    in repo, which happens when modules fetched with '--fetch partial' are
+    not checked out. Such objects are available only from promisor remotes.
+    """
+    for line in utils.iter_lines(
+            ['git', 'rev-list', '--objects', '--missing=print', '--all'],
+            workdir=repo):
+        if line.startswith('?'):
+            return True
+    return False
 
 
-def merge_module_branch(repo, branch, module):
-    """Merges new state of module branch to base branch."""
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git checkout {branch} && '
-        'git merge --squash -s subtree '
-            '--no-commit {branch}-{module} && '
-        'git stash'.format(**locals())
+def remove_partial_remotes(config, repo):
+    """Removes promisor remotes recorded by partial fetches and restores
+    repository format version, unless objects fetched partially are still
+    missing.
+    """
+    remotes = partial_remotes(repo)
+    if not remotes:
+        return
+    if has_missing_objects(repo):
+        utils.shout(
+            'Some objects are available only from upstream repos, keeping '
+            'promisor remotes: {0}'.format(', '.join(sorted(remotes))),
+            verbose=True,
+            level='warning'
+        )
+        return
+    removed = git.remove_config_sections(
+        repo, [('remote', name) for name in remotes]
+    )
+    for section, name in sorted(removed):
+        utils.shout(
+            'Removed promisor remote {0}'.format(name),
+            verbose=config.verbose,
+            level='info'
+        )
+    session = git.get_session(repo)
+    if session.config('extensions.partialclone') in remotes:
+        rc, stdout, stderr = utils.run(
+            ['git', 'config', '--unset', 'extensions.partialclone'],
+            workdir=repo
+        )
+    rc, stdout, stderr = utils.run(
+        ['git', 'config', '--get-regexp', r'^extensions\.'],
+        workdir=repo, can_fail=False
     )
+    if not stdout and not partial_remotes(repo) and \
+            session.config('core.repositoryformatversion') == '1':
+        # version 1 is needed only by extensions
+        rc, stdout, stderr = utils.run(
+            ['git', 'config', 'core.repositoryformatversion', '0'],
+            workdir=repo
+        )
+    session.invalidate()
 
 
 def command(config, repo, branch):
-    """Updates git subtree hierarchy according to the Puppetfile
-    located in given 'repo'.
+    """Removes module refs of given base 'branch' together with module
+    branches and module remotes (including their remote-tracking branches)
+    created by older versions of bade. All refs are deleted in one
+    transaction and all remotes in one config edit, failures are reported
+    per item. Promisor remotes recorded by partial fetches are removed
+    too.
     """
     current_branch = utils.get_current_branch(repo)
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git checkout {branch}'.format(**locals())
-    )
-
     puppetfile = utils.PuppetFile(repo)
     puppetfile.load()
 
     branches = [
         '{0}-{1}'.format(branch, module) for module in puppetfile.keys()
     ]
-    can_go_back = current_branch not in branches
-
-    for module_branch in branches:
-        _locals = locals()
-        utils.shout(
-            'Removing branch {module_branch}'.format(**_locals),
-            verbose=config.verbose,
-            level='info'
-        )
-        rc, stdout, stderr = utils.execute(
-            'cd {repo} && '
-            'git branch -D {module_branch}'.format(**_locals),
-            can_fail=False
+    if current_branch in branches:
+        # legacy module branch is checked out
+        rc, stdout, stderr = utils.run(
+            ['git', 'checkout', branch], workdir=repo
         )
-        if rc:
+
+    # find module refs, legacy module branches and module remotes
+    refs = {}
+    prefixes = ['refs/remotes/{0}/'.format(name) for name in branches]
+
+    def collect(line):
+        sha, ref = line.rstrip('\n').split(' ', 1)
+        refs[ref] = sha
+
+    # legacy module remotes can have lots of remote-tracking branches
+    rc, stdout, stderr = utils.run(
+        ['git', 'for-each-ref', '--format=%(objectname) %(refname)',
+         'refs/bade/{0}/'.format(branch)] +
+        ['refs/heads/{0}'.format(name) for name in branches] + prefixes,
+        workdir=repo, stream=collect
+    )
+
+    failed = delete_refs(repo, refs)
+    for ref in sorted(refs):
+        if ref in failed:
             utils.shout(
-                'Failed to remove branch {module_branch}'.format(**_locals),
+                'Failed to remove ref {0}'.format(ref),
                 verbose=True,
                 level='warning'
             )
-        utils.shout(
-            'Removing remote {module_branch}'.format(**_locals),
-            verbose=config.verbose,
-            level='info'
-        )
-        rc, stdout, stderr = utils.execute(
-            'cd {repo} && '
-            'git remote remove {module_branch}'.format(**_locals),
-            can_fail=False
-        )
-        if rc:
+        else:
             utils.shout(
-                'Failed to remove remote {module_branch}'.format(**_locals),
-                verbose=True,
-                level='warning'
+                'Removed ref {0}'.format(ref),
+                verbose=config.verbose,
+                level='info'
             )
 
-    if can_go_back:
-        rc, stdout, stderr = utils.execute(
-            'cd {repo} && '
-            'git checkout {current_branch}'.format(**locals())
-        )
+    removed = git.remove_config_sections(
+        repo,
+        [('remote', name) for name in branches] +
+        [('branch', name) for name in branches]
+    )
+    for section, name in sorted(removed):
+        if section == 'remote':
+            utils.shout(
+                'Removed remote {0}'.format(name),
+                verbose=config.verbose,
+                level='info'
+            )
+
+    remove_partial_remotes(config, repo)
@@ -1,128 +1,650 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
 import os
+import re
+import shutil
+import tempfile
+import time
 
+from .. import engine
+from .. import git
+from .. import hosts
+from .. import mirror
+from .. import tracing
 from .. import utils
 
 
-def create_module_branch(repo, branch, module, info):
-    """Creates module branch for given 'module' from git repo and
-    commit given by 'info' dict. Parameter 'branch' states to which
-    branch will be the module branch imported.
+RE_HASH = re.compile(r'^[0-9a-fA-F]{7,40}$')
+# {temporary index: stamp of the repo's index it was copied from}
+_index_stamps = {}
+
+
+def module_ref(branch, module):
+    """Returns name of ref which holds state of 'module' imported
+    to base 'branch'.
+    """
+    return 'refs/bade/{branch}/{module}'.format(**locals())
+
+
+def pinned_commit(info):
+    """Returns tuple (commit, is_hash) of the commit or ref pinned
+    in Puppetfile module 'info'. Pins which look like (abbreviated) commit
+    hashes are considered hashes, pins resolved through Puppetfile.lock
+    are always full hashes.
+    """
+    commit = info['commit'] if 'commit' in info else info['ref']
+    return commit, bool(RE_HASH.match(commit))
+
+
+def mirror_refspecs(info):
+    """Returns refspecs which fetch just the commit pinned in 'info' from
+    upstream repo to its local mirror.
+    """
+    commit, is_hash = pinned_commit(info)
+    if is_hash:
+        # keep the commit referenced, so that it survives gc in mirror
+        return ['{0}:refs/bade/pinned/{0}'.format(commit)]
+    return ['+refs/heads/{0}:refs/heads/{0}'.format(commit)]
+
+
+@utils.retry(count=3, delay=1, backoff=2, jitter=0.5, max_delay=30,
+             retry_on=utils.ExecutionError)
+@tracing.step('fetch')
+def fetch_module(repo, branch, module, info, mirror_dir=None,
+                 strategy='full'):
+    """Fetches commit pinned in 'info' to module ref. No remote is created,
+    the commit is fetched by URL of upstream repo or of its local mirror in
+    case 'mirror_dir' is given. Strategy 'shallow' fetches just the pinned
+    commit without history, strategy 'partial' in addition skips blobs
+    until they are needed (only when fetching directly from upstream).
+    Mirror is synced from upstream only if it does not contain pinned
+    commit yet. In case upstream refuses to serve single commit, all its
+    branches and tags are fetched. This step does not touch working tree
+    nor index, so it is safe to run it for several modules at once.
     """
-    _locals = locals()
-    @utils.retry(count=3, retry_on=utils.ExecutionError)
-    def fetch():
-        rc, stdout, stderr = utils.execute(
-            'cd {repo} && '
-            'git fetch {branch}-{module}'.format(**_locals)
+    if mirror_dir or strategy != 'shallow':
+        return fetch_pinned(repo, branch, module, info, mirror_dir, strategy)
+    # shallow fetches rewrite .git/shallow and have to be serialized, so
+    # upstream is fetched to temporary mirror first and only the local
+    # fetch from it to repo is serialized
+    scratch = tempfile.mkdtemp(
+        prefix='bade-mirror-', dir=git.get_session(repo).git_dir()
+    )
+    try:
+        fetch_pinned(repo, branch, module, info, scratch, strategy)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def fetch_pinned(repo, branch, module, info, mirror_dir, strategy):
+    """Fetches commit pinned in 'info' to module ref, see fetch_module()."""
+    ref = module_ref(branch, module)
+    commit, is_hash = pinned_commit(info)
+    refspec = '+{commit}:{ref}'.format(**locals())
+    fetch = ['git', 'fetch', '--no-tags', '--no-write-fetch-head']
+    source = info['git']
+    mirrored = False
+    if mirror_dir:
+        source = mirror.ensure(info['git'], mirror_dir)
+        # pinned commit is already mirrored, upstream need not be asked
+        mirrored = is_hash and bool(pinned_object(source, info))
+    if strategy in ('shallow', 'partial'):
+        args = ['--depth', '1']
+        if strategy == 'partial' and not mirror_dir:
+            args.append('--filter=blob:none')
+        try:
+            if mirror_dir and not mirrored:
+                mirror.sync(
+                    info['git'], mirror_dir, refspecs=mirror_refspecs(info),
+                    depth=1
+                )
+            # shallow fetches rewrite .git/shallow, so those can not
+            # run concurrently in one repo
+            with git.repo_lock(repo):
+                rc, stdout, stderr = utils.run(
+                    fetch + args + [source, refspec], workdir=repo
+                )
+            return
+        except utils.ExecutionError as ex:
+            utils.shout(
+                'Shallow fetch of {0} failed, falling back to full '
+                'fetch: {1}'.format(module, ex.stderr.strip()),
+                verbose=True,
+                level='warning'
+            )
+    # commits in shallow mirror lack history needed for full fetch
+    if mirror_dir and not (mirrored and not mirror.is_shallow(source)):
+        mirror.sync(info['git'], mirror_dir)
+    rc, stdout, stderr = utils.run(
+        fetch + [source, refspec], workdir=repo, can_fail=not is_hash
+    )
+    if not rc:
+        return
+    # upstream does not serve commits by hash
+    tmp = 'refs/bade-fetch/{branch}/{module}/'.format(**locals())
+    try:
+        rc, stdout, stderr = utils.run(
+            fetch + [source, '+refs/heads/*:{0}heads/*'.format(tmp),
+                     '+refs/tags/*:{0}tags/*'.format(tmp)],
+            workdir=repo
+        )
+        rc, stdout, stderr = utils.run(
+            ['git', 'update-ref', ref, '{0}^{{commit}}'.format(commit)],
+            workdir=repo
+        )
+    finally:
+        rc, stdout, stderr = utils.run(
+            ['git', 'for-each-ref', '--format=delete %(refname)', tmp],
+            workdir=repo
+        )
+        rc, stdout, stderr = utils.run(
+            ['git', 'update-ref', '--stdin'], workdir=repo, input=stdout
         )
 
-    # cleanup
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git remote rm {branch}-{module}'.format(**_locals),
-        can_fail=False
+
+@tracing.step('resolve')
+def pin_module_ref(repo, branch, module, info):
+    """Points module ref to commit pinned in 'info', which has to be present
+    in repo already.
+    """
+    commit, is_hash = pinned_commit(info)
+    rc, stdout, stderr = utils.run(
+        ['git', 'update-ref', module_ref(branch, module),
+         '{0}^{{commit}}'.format(commit)],
+        workdir=repo
     )
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git checkout {branch} && '
-        'git branch -D {branch}-{module}'.format(**_locals),
-        can_fail=False
+
+
+@tracing.step('import')
+def import_module(repo, branch, module, commit=None, env=None):
+    """Replaces content of module's directory in the index by the tree
+    of module ref (or of given 'commit'). Working tree is left untouched,
+    see checkout_modules(). Index other than the repo's one can be given
+    by GIT_INDEX_FILE in 'env'.
+    """
+    commit = commit or module_ref(branch, module)
+    rc, stdout, stderr = utils.run(
+        ['git', 'rm', '--cached', '-r', '-q', '-f', '--ignore-unmatch',
+         '--', module],
+        workdir=repo, env=env
     )
-    # fetch remote repo
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git remote add {branch}-{module} '
-            '{info[git]}'.format(**_locals)
+    rc, stdout, stderr = utils.run(
+        ['git', 'read-tree', '--prefix={0}/'.format(module), commit],
+        workdir=repo, env=env
     )
-    fetch()
-    # (re)create branch from given commit
-    commit = info['commit'] if 'commit' in info else info['ref']
+
+
+@tracing.step('checkout')
+def checkout_modules(repo, modules):
+    """Replaces directories of given modules in working tree by their
+    content in the index. This is the only step which touches working tree.
+    """
+    if not modules:
+        return
+    for module in modules:
+        shutil.rmtree(os.path.join(repo, module), ignore_errors=True)
+    rc, stdout, stderr = utils.run(
+        ['git', 'checkout', '-q', '--'] + list(modules), workdir=repo
+    )
+
+
+def read_branch(repo, branch, worktree=False):
+    """Returns tuple (commit, Puppetfile, lock file) of tip of given base
+    'branch'. Puppetfile and lock file are read from working tree
+    if 'worktree' is True, otherwise from the tip commit, so that the
+    branch does not have to be checked out.
+    """
+    session = git.get_session(repo)
+    tip = session.resolve('refs/heads/{0}'.format(branch))
+    puppetfile = utils.PuppetFile(repo)
+    lock = utils.LockFile(repo)
+    if worktree:
+        puppetfile.load()
+        lock.load()
+        return tip, puppetfile, lock
+    if not tip:
+        raise utils.ExecutionError(
+            'Branch {0} does not exist'.format(branch),
+            stdout='', stderr=''
+        )
+    for name, target in (('Puppetfile', puppetfile),
+                         ('Puppetfile.lock', lock)):
+        blob = session.read('{0}:{1}'.format(tip, name))
+        if blob and blob[1] == 'blob':
+            target.loads(blob[2])
+        elif target is puppetfile:
+            raise utils.ExecutionError(
+                'Branch {0} does not contain Puppetfile'.format(branch),
+                stdout='', stderr=''
+            )
+    return tip, puppetfile, lock
+
+
+def uses_worktree(repo, branch, checkout=True):
+    """Returns True if commit of base 'branch' should be assembled from
+    index and working tree of the repo, which is the case when the branch
+    is checked out and those should be updated to the commit.
+    """
+    return checkout and git.get_session(repo).current_branch() == branch
+
+
+def index_stamp(path):
+    """Returns (inode, mtime, size) of given index file or None if it does
+    not exist. Git replaces index file on each write, so the stamp tells
+    whether the index has changed.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+def copy_index(repo, index):
+    """Copies the repo's index to 'index' file and records its stamp."""
+    current = os.path.join(git.get_session(repo).git_dir(), 'index')
+    with git.index_lock(repo):
+        _index_stamps[index] = index_stamp(current)
+        if os.path.exists(current):
+            shutil.copyfile(current, index)
+        elif os.path.exists(index):
+            os.unlink(index)
+
+
+@contextlib.contextmanager
+def temporary_index(repo, branch, tip=None, worktree=False):
+    """Yields environment with GIT_INDEX_FILE pointing to temporary index
+    of base 'branch' filled with copy of the repo's index if 'worktree'
+    is True or with tree of commit 'tip' (empty if 'tip' is None).
+    The index is removed on exit.
+    """
+    session = git.get_session(repo)
+    index = os.path.join(
+        session.git_dir(), 'bade-index-{0}'.format(branch.replace('/', '-'))
+    )
+    env = {'GIT_INDEX_FILE': index}
+    try:
+        if worktree:
+            copy_index(repo, index)
+        else:
+            rc, stdout, stderr = utils.run(
+                ['git', 'read-tree'] + ([tip] if tip else ['--empty']),
+                workdir=repo, env=env
+            )
+        yield env
+    finally:
+        _index_stamps.pop(index, None)
+        if os.path.exists(index):
+            os.unlink(index)
+
+
+def local_changes(repo, modules):
+    """Returns list of paths in directories of given modules which differ
+    from the index or are not tracked.
+    """
+    if not modules:
+        return []
+    rc, stdout, stderr = utils.run(
+        ['git', 'ls-files', '-z', '--modified', '--deleted', '--others',
+         '--exclude-standard', '--'] + list(modules),
+        workdir=repo
+    )
+    return sorted(set(path for path in stdout.split('\0') if path))
+
+
+def replace_index(repo, index):
+    """Replaces index of the repo by given index file, holding index.lock
+    the same way git does it.
+    """
+    path = os.path.join(git.get_session(repo).git_dir(), 'index')
+    lock_path = '{0}.lock'.format(path)
+    try:
+        fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except OSError as ex:
+        raise utils.ExecutionError(
+            'Unable to lock {0}: {1}'.format(path, ex.strerror),
+            stdout='', stderr=str(ex)
+        )
     try:
-        int(commit, 16)
-    except ValueError:
-        # ref is in branch name format
-        commit = '{branch}-{module}/{commit}'.format(**locals())
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git checkout -B {branch}-{module} {commit} && '
-        'git checkout {branch}'.format(**locals())
+        os.close(fd)
+        os.rename(index, path)
+    finally:
+        os.unlink(lock_path)
+
+
+def write_commit(repo, tip, env, files, msg):
+    """Adds {path: content} 'files' to temporary index given by 'env'
+    and creates commit of its tree on top of 'tip'. Returns hash of the
+    commit or None if its tree would be the same as the tree of 'tip'.
+    """
+    session = git.get_session(repo)
+    for name, content in sorted(files.items()):
+        rc, stdout, stderr = utils.run(
+            ['git', 'hash-object', '-w', '--stdin'], workdir=repo,
+            input=content
+        )
+        rc, stdout, stderr = utils.run(
+            ['git', 'update-index', '--add', '--cacheinfo',
+             '100644,{0},{1}'.format(stdout.strip(), name)],
+            workdir=repo, env=env
+        )
+    rc, stdout, stderr = utils.run(
+        ['git', 'write-tree'], workdir=repo, env=env
     )
+    tree = stdout.strip()
+    if tip and tree == session.tree(tip):
+        return None
+    rc, stdout, stderr = utils.run(
+        ['git', 'commit-tree', tree] + (['-p', tip] if tip else []) +
+        ['-m', msg],
+        workdir=repo
+    )
+    return stdout.strip()
+
+
+def refresh_index(repo, branch, env, modules):
+    """Copies the repo's index to temporary index given by 'env' again
+    and imports given modules to it, in case the repo's index has changed
+    since the temporary index was copied from it. Has to be called with
+    index lock held.
+    """
+    index = env['GIT_INDEX_FILE']
+    current = os.path.join(git.get_session(repo).git_dir(), 'index')
+    if _index_stamps.get(index) == index_stamp(current):
+        return
+    copy_index(repo, index)
+    for module in modules:
+        import_module(repo, branch, module, env=env)
+
+
+@tracing.step('commit')
+def commit_index(repo, branch, tip, env, files, msg, modules,
+                 worktree=False):
+    """Creates commit of base 'branch' on top of commit 'tip' (None for
+    the first commit) from temporary index given by 'env' with {path:
+    content} 'files' added to it. In case 'worktree' is True (the index
+    was copied from the repo's index), the index is assembled again from
+    the repo's index if that has changed meanwhile. Once the branch is
+    moved to the commit, given files are written to working tree, the
+    index replaces the repo's index and directories of given modules are
+    checked out, so only changed paths are touched. Local changes in those
+    directories are never overwritten, the commit is refused instead.
+    Returns hash of the new commit or None if its tree would be the same
+    as the tree of 'tip'.
+    """
+    with git.index_lock(repo):
+        if worktree:
+            refresh_index(repo, branch, env, modules)
+            changes = local_changes(repo, modules)
+            if changes:
+                raise utils.ExecutionError(
+                    'Local changes in module directories would be '
+                    'overwritten, commit or discard them first: {0}'.format(
+                        ', '.join(changes)
+                    ),
+                    stdout='', stderr=''
+                )
+        new = write_commit(repo, tip, env, files, msg)
+        if new is None:
+            return None
+        # the branch is moved first, so that index and working tree are not
+        # updated in case the branch has moved since 'tip' was read
+        rc, stdout, stderr = utils.run(
+            ['git', 'update-ref', '-m', 'bade',
+             'refs/heads/{0}'.format(branch), new, tip or '0' * 40],
+            workdir=repo
+        )
+        if worktree:
+            for name, content in sorted(files.items()):
+                with open(os.path.join(repo, name), 'w') as fobj:
+                    fobj.write(content)
+            replace_index(repo, env['GIT_INDEX_FILE'])
+            checkout_modules(repo, modules)
+    return new
+
+
+def is_module_current(repo, module, info, mirror_dir=None, tree=None):
+    """Returns True if tree of module's prefix in HEAD is the same as tree
+    of the commit pinned in Puppetfile or as given 'tree' hash (recorded
+    in Puppetfile.lock). Modules pinned to branch names have to be fetched
+    to find out, so without 'tree' those are never considered current.
+    """
+    current = git.get_session(repo).tree('HEAD', prefix=module)
+    if not current:
+        return False
+    if tree:
+        return current == tree
+    commit, is_hash = pinned_commit(info)
+    if not is_hash:
+        return False
+    return current == pinned_object(repo, info, mirror_dir, 'tree')
+
+
+def pinned_object(repo, info, mirror_dir=None, kind='commit'):
+    """Returns full hash of commit (or its tree if 'kind' is 'tree') pinned
+    in 'info'. The commit is looked up in repo and in local mirror
+    of upstream repo. Returns None if the commit is not available locally.
+    """
+    commit, is_hash = pinned_commit(info)
+    paths = [repo]
+    if mirror_dir:
+        path = mirror.mirror_path(info['git'], mirror_dir)
+        if os.path.isdir(path):
+            paths.append(path)
+    for path in paths:
+        result = git.get_session(path).check(
+            '{0}^{{{1}}}'.format(commit, kind)
+        )
+        if result:
+            return result[0]
+    return None
+
+
+def lock_module(repo, branch, module, info, lock):
+    """Records commit and tree of module ref to 'lock'."""
+    session = git.get_session(repo)
+    commit = session.resolve(module_ref(branch, module))
+    lock.set(module, info, commit, session.tree(commit))
 
 
-def import_module_branch(repo, branch, module):
-    """Pulls appropriate repo branch to given branch."""
-    _locals = locals()
-    # cleanup
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git checkout {branch} && '
-        'git reset HEAD {module} && '
-        'git checkout -- {module}'.format(**_locals),
-        can_fail=False
+def fetch_remote(config, runner, stats, repo, branch, module, info):
+    """Fetches module to module ref of 'branch' holding the limit of
+    concurrent fetches from module's upstream host in 'runner' engine.
+    Duration of the fetch is recorded to host statistics 'stats'.
+    """
+    host = engine.remote_key(info['git'])
+    with runner.remote(info['git']):
+        start = time.time()
+        try:
+            fetch_module(
+                repo, branch, module, info,
+                mirror_dir=config.mirror_dir, strategy=config.fetch
+            )
+        except Exception:
+            stats.record(host, time.time() - start, failed=True)
+            raise
+        stats.record(host, time.time() - start)
+
+
+def sync_modules(config, repo, branch, targets, modules, jobs=1,
+                 fetch=None, imported=None, env=None):
+    """Imports given modules to 'branch' using pool of 'jobs' workers.
+    Module info is taken from 'targets' mapping. Pipeline of each module
+    fetches it to module ref (only modules in 'fetch', if given, others
+    are already present in repo) and imports it to the index. Fetches run
+    concurrently (limited per upstream host), imports are serialized.
+    Modules of hosts which were slowest in previous runs are started first.
+    Callable 'imported' is called with name of each imported module while
+    the index is still locked. Working tree is updated once all modules
+    are imported, unless modules are imported to temporary index given
+    by GIT_INDEX_FILE in 'env'. Returns list of (module, error) tuples
+    for modules which failed.
+    """
+    stats = hosts.HostStats()
+    stats.load()
+    runner = engine.Engine(
+        repo, jobs=jobs, remote_jobs=config.host_jobs, hosts=stats
     )
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git checkout {branch} && '
-        'rm -fr {module}'.format(**_locals)
+
+    def pipeline(module):
+        info = targets[module]
+        if fetch is None or module in fetch:
+            fetch_remote(config, runner, stats, repo, branch, module, info)
+        else:
+            pin_module_ref(repo, branch, module, info)
+        with runner.ordered():
+            utils.shout(
+                'Importing module {0} to branch {1}'.format(module, branch),
+                verbose=config.verbose,
+                level='info'
+            )
+            import_module(repo, branch, module, env=env)
+            if imported:
+                imported(module)
+
+    modules = stats.order(
+        modules, lambda module: engine.remote_key(targets[module]['git'])
     )
-    # pull the branch
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git checkout {branch} && '
-        'git read-tree --prefix={module}/ '
-            '-u {branch}-{module}'.format(**_locals)
+    failed = []
+    try:
+        results = runner.run(pipeline, modules)
+    finally:
+        stats.save()
+    for module, result, error in results:
+        if error is not None:
+            failed.append((module, error))
+            utils.shout(
+                'Failed to synchronize module {0} for branch {1}: '
+                '{2}'.format(module, branch, error),
+                verbose=True,
+                level='error'
+            )
+    if env is None:
+        failed_modules = [module for module, error in failed]
+        checkout_modules(
+            repo,
+            [module for module in modules if module not in failed_modules]
+        )
+    return failed
+
+
+def fetch_error(failed):
+    """Returns ExecutionError summarizing modules which failed."""
+    return utils.ExecutionError(
+        'Failed to synchronize modules: {0}'.format(
+            ', '.join(module for module, error in failed)
+        ),
+        stdout='\n'.join(
+            getattr(error, 'stdout', '') for module, error in failed
+        ),
+        stderr='\n'.join(
+            getattr(error, 'stderr', str(error)) for module, error in failed
+        )
     )
 
 
-def command(config, repo, commit):
+def command(config, repo, commit, jobs=1, force=False, update_lock=False,
+            checkout=True):
     """Creates git subtree hierarchy according to the Puppetfile
-    located in given 'repo'.
+    located in given 'repo'. Modules are synchronized using pool
+    of 'jobs' workers, imports are run serially. Modules which
+    are already at the pinned commit are skipped unless 'force' is True.
+    Modules are pinned to commits recorded in Puppetfile.lock, modules
+    pinned to branch names are resolved again if 'update_lock' is True.
+    In case 'commit' is True the commit is assembled in temporary index
+    and index and working tree are updated to it afterwards. If 'checkout'
+    is False, the commit is assembled from HEAD (including Puppetfile)
+    and index and working tree are left untouched.
     """
-    puppetfile = utils.PuppetFile(repo)
-    puppetfile.load()
     branch = utils.get_current_branch(repo)
+    worktree = not commit or uses_worktree(repo, branch, checkout)
+    tip, puppetfile, lock = read_branch(repo, branch, worktree=worktree)
+    session = git.get_session(repo)
+    targets = {}
+    modules = []
+    for module in sorted(puppetfile.keys()):
+        info = puppetfile[module]
+        entry = lock.get(module, info)
+        if update_lock and not pinned_commit(info)[1]:
+            entry = None
+        targets[module] = lock.resolve(module, info) if entry else dict(info)
+        if not force and is_module_current(
+                repo, module, targets[module], mirror_dir=config.mirror_dir,
+                tree=entry['tree'] if entry else None):
+            utils.shout(
+                'Module {0} is up to date on branch {1}'.format(
+                    module, branch
+                ),
+                verbose=config.verbose,
+                level='info'
+            )
+            if not entry:
+                pinned = pinned_object(repo, info, config.mirror_dir)
+                if pinned:
+                    lock.set(module, info, pinned,
+                             session.tree('HEAD', prefix=module))
+            continue
+        modules.append(module)
 
-    for module, info in puppetfile.items():
-        utils.shout(
-            'Initializing branch for {0} on branch {1}'.format(
-                module, branch
+    # commits which are already present in repo do not have to be fetched
+    fetch = []
+    for module in modules:
+        pinned, is_hash = pinned_commit(targets[module])
+        result = session.check('{0}^{{commit}}'.format(pinned))
+        if not is_hash or not result:
+            fetch.append(module)
+
+    def synchronize(env=None):
+        failed = sync_modules(
+            config, repo, branch, targets, modules, jobs=jobs, fetch=fetch,
+            imported=lambda module: lock_module(
+                repo, branch, module, puppetfile[module], lock
             ),
-            verbose=config.verbose,
-            level='info'
+            env=env
         )
-        create_module_branch(repo, branch, module, info)
-        utils.shout(
-            'Pulling module branch {0}-{1} to branch {0}'.format(
-                branch, module
-            ),
-            verbose=config.verbose,
-            level='info'
-        )
-        import_module_branch(repo, branch, module)
+        lock.prune(puppetfile.keys())
+        if failed:
+            raise fetch_error(failed)
 
-    if commit:
-        utils.shout(
-            'Generating commit',
-            verbose=config.verbose,
-            level='info'
-        )
-        paths = ' '.join(puppetfile.keys())
+    if not commit:
+        try:
+            synchronize()
+        finally:
+            lock.save()
+        return
+
+    with temporary_index(repo, branch, tip, worktree=worktree) as env:
+        synchronize(env)
         status = ''
         for mod in sorted(puppetfile.keys()):
-            commit = (
-                puppetfile[mod]['commit'] if 'commit' in puppetfile[mod] else
-                puppetfile[mod]['ref']
-            )
+            commit, is_hash = pinned_commit(puppetfile[mod])
+            if mod in lock and lock[mod]['commit'] != commit:
+                commit = '{0} ({1})'.format(commit, lock[mod]['commit'])
             status += (
-                '{mod}\\n - initial commit: {commit}\\n\\n'.format(
+                '{mod}\n - initial commit: {commit}\n\n'.format(
                     mod=mod, commit=commit
                 )
             )
-        msg = utils.COMMIT_MSG.format(status)
-        rc, stdout, stderr = utils.execute(
-            'cd {repo} && '
-            'git add {paths} --ignore-errors && '
-            'git commit -m $\'{msg}\''.format(**locals())
+        files = {
+            'Puppetfile': puppetfile.dumps(),
+            'Puppetfile.lock': lock.dumps(),
+        }
+        new = commit_index(
+            repo, branch, tip, env, files, utils.COMMIT_MSG.format(status),
+            modules, worktree=worktree
+        )
+    if new is None:
+        utils.shout(
+            'All modules are up to date, skipping commit',
+            verbose=config.verbose,
+            level='info'
+        )
+        if worktree:
+            lock.save()
+    else:
+        utils.shout(
+            'Generated commit {0}'.format(new),
+            verbose=config.verbose,
+            level='info'
         )
@@ -1,119 +1,342 @@
 # -*- coding: utf-8 -*-
 
-import codecs
 import datetime
-import jinja2
+import hashlib
+import json
 import os
+import shutil
+import threading
 
+from .. import git
 from .. import utils
 from . import init
 
 
-# setup jinja environment
-jinja_env = jinja2.Environment(
-    block_start_string='[@',
-    block_end_string='@]',
-    variable_start_string='[[',
-    variable_end_string=']]',
-    trim_blocks=True,
-    loader=jinja2.FileSystemLoader([
-        # bades built-in templates
-        os.path.join(
-            os.path.dirname(os.path.dirname(__file__)), 'templates'
-        ),
-        # user's templates
-        os.path.join(
-            os.path.expanduser('~'), '.bade', 'templates'
-        )
-    ])
-)
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.bade', 'cache')
+TARBALL_JOBS = 4
+TEMPLATE_DIRS = [
+    # bades built-in templates
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates'),
+    # user's templates
+    os.path.join(os.path.expanduser('~'), '.bade', 'templates'),
+]
+
+_jinja_env = None
+_metadata_cache = {}
+_metadata_lock = threading.Lock()
+
 
 def format_datetime(value):
     return value.strftime('%a %b %d %Y')
-jinja_env.filters['datetime'] = format_datetime
 
 
 def format_global(value):
     return value.replace('-', '_')
-jinja_env.filters['global'] = format_global
 
 
 def format_rjust(value, value_from, offset):
     space = offset - len(value_from) + len(value)
     return value.rjust(space)
-jinja_env.filters['rjust'] = format_rjust
 
 
-def command(config, repo, version, release, old, output, template):
-    """Generates SPEC file from template and tags repo accordingly.
+def get_jinja_env(cache_dir=CACHE_DIR):
+    """Returns jinja environment for SPEC templates. The environment is
+    created on first call. Compiled templates are cached in 'cache_dir',
+    cache entries are invalidated when template source changes.
+    """
+    global _jinja_env
+    if _jinja_env is not None:
+        return _jinja_env
+    import jinja2
+
+    bytecode_cache = None
+    if cache_dir:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        except OSError as ex:
+            utils.LOG.warning(
+                'Failed to create template cache {0}: {1}'.format(
+                    cache_dir, ex
+                )
+            )
+    _jinja_env = jinja2.Environment(
+        block_start_string='[@',
+        block_end_string='@]',
+        variable_start_string='[[',
+        variable_end_string=']]',
+        trim_blocks=True,
+        loader=jinja2.FileSystemLoader(TEMPLATE_DIRS),
+        bytecode_cache=bytecode_cache
+    )
+    _jinja_env.filters['datetime'] = format_datetime
+    _jinja_env.filters['global'] = format_global
+    _jinja_env.filters['rjust'] = format_rjust
+    return _jinja_env
+
+
+def render_target(context, template, output, release):
+    """Renders 'template' with given 'context' and 'release' to 'output'.
+    Returns False if 'output' already had the same content and so it was
+    not rewritten.
+    """
+    _locals = dict(context, template=template, output=output,
+                   release=release)
+    content = get_jinja_env().get_template(template).render(**_locals)
+    content = content.encode('utf-8')
+    path = os.path.abspath(output)
+    if os.path.exists(path):
+        with open(path, 'rb') as ofile:
+            current = hashlib.sha256(ofile.read()).hexdigest()
+        if current == hashlib.sha256(content).hexdigest():
+            return False
+    with open(path, 'wb') as ofile:
+        ofile.write(content)
+    return True
+
+
+def archive_tree(repo, tree, prefix, cache_dir=CACHE_DIR):
+    """Returns tuple (path, sha256) of tar.gz archive of given 'tree' with
+    content placed to 'prefix' directory. Archives are cached in
+    'cache_dir' by tree hash and prefix, so each tree is archived once.
     """
+    directory = os.path.join(cache_dir, 'tarballs')
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created by concurrent job
+            if not os.path.isdir(directory):
+                raise
+    path = os.path.join(directory, '{0}-{1}.tar.gz'.format(prefix, tree))
+    checksum = '{0}.sha256'.format(path)
+    if os.path.exists(path) and os.path.exists(checksum):
+        with open(checksum) as cached:
+            return path, cached.read().strip()
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    rc, stdout, stderr = utils.run(
+        ['git', 'archive', '--format=tar.gz',
+         '--prefix={0}/'.format(prefix), '-o', tmp, tree],
+        workdir=repo
+    )
+    digest = hashlib.sha256()
+    with open(tmp, 'rb') as archive:
+        for chunk in iter(lambda: archive.read(1 << 16), b''):
+            digest.update(chunk)
+    os.rename(tmp, path)
+    with open('{0}.tmp'.format(checksum), 'w') as cached:
+        cached.write(digest.hexdigest() + '\n')
+    os.rename('{0}.tmp'.format(checksum), checksum)
+    return path, digest.hexdigest()
+
+
+def module_tree(repo, module, info, lock):
+    """Returns hash of module's tree recorded in Puppetfile.lock or present
+    in HEAD, None if there is no such tree.
+    """
+    entry = lock.get(module, info)
+    if entry:
+        return entry['tree']
+    return git.get_session(repo).tree('HEAD', prefix=module)
+
+
+def load_metadata(repo, puppetfile, lock):
+    """Returns {module: metadata} mapping with content of metadata.json
+    of each module. Blobs are looked up and read through query session
+    of the repo, without touching working tree. Parsed content is cached
+    by blob hash. Modules without metadata.json get empty dict.
+    """
+    session = git.get_session(repo)
+    metadata = {}
+    for module, info in puppetfile.items():
+        tree = module_tree(repo, module, info, lock)
+        blob = tree and session.check('{0}:metadata.json'.format(tree))
+        if not blob or blob[1] != 'blob':
+            metadata[module] = {}
+            continue
+        with _metadata_lock:
+            content = _metadata_cache.get(blob[0])
+        if content is None:
+            try:
+                content = json.loads(session.read(blob[0])[2])
+            except ValueError as ex:
+                utils.LOG.warning(
+                    'Ignoring invalid metadata.json of module {0}: '
+                    '{1}'.format(module, ex)
+                )
+                content = {}
+            with _metadata_lock:
+                _metadata_cache[blob[0]] = content
+        metadata[module] = content
+    return metadata
+
+
+def dependency_graph(puppetfile, metadata):
+    """Returns {module: [module, ...]} mapping of modules in Puppetfile
+    to modules in Puppetfile they depend on according to their metadata.
+    Dependencies are matched by module name ("author/name" or
+    "author-name" in metadata).
+    """
+    graph = {}
+    for module in puppetfile.keys():
+        requires = set()
+        for dependency in metadata.get(module, {}).get('dependencies', []):
+            name = dependency.get('name', '').replace('/', '-')
+            name = name.split('-', 1)[-1]
+            if name in puppetfile and name != module:
+                requires.add(name)
+        graph[module] = sorted(requires)
+    return graph
+
+
+def build_tarballs(config, repo, puppetfile, lock, directory, jobs=1):
+    """Creates tar.gz archive of each module's tree (as recorded
+    in Puppetfile.lock or present in HEAD) in 'directory' using pool
+    of 'jobs' workers. Archives of unchanged trees are taken from cache.
+    Returns {module: (file name, sha256)} mapping.
+    """
+    trees = {}
+    for module, info in puppetfile.items():
+        trees[module] = module_tree(repo, module, info, lock)
+        if not trees[module]:
+            raise utils.ExecutionError(
+                'Module {0} is not present in HEAD, run "bade init" '
+                'first'.format(module),
+                stdout='', stderr=''
+            )
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    def build(module):
+        path, sha256 = archive_tree(repo, trees[module], module)
+        name = '{0}-{1}.tar.gz'.format(module, trees[module][:12])
+        target = os.path.join(directory, name)
+        if not os.path.exists(target):
+            utils.shout(
+                'Creating tarball {0}'.format(target),
+                verbose=config.verbose,
+                level='info'
+            )
+            try:
+                os.link(path, target)
+            except OSError:
+                # cache on different filesystem
+                shutil.copyfile(path, target)
+        return name, sha256
+
+    tarballs = {}
+    for module, result, error in utils.parallel(
+            build, sorted(trees), jobs=jobs):
+        if error is not None:
+            raise error
+        tarballs[module] = result
+    return tarballs
+
+
+def command(config, repo, version, release, old, output, template,
+            targets=None, tarballs=None, jobs=TARBALL_JOBS):
+    """Generates SPEC files from templates and tags repo accordingly.
+    Each of 'targets' is (template, output, release) tuple, by default
+    single target given by 'template', 'output' and 'release' is generated.
+    Puppetfile, old SPEC file and git metadata are loaded once for all
+    targets, targets are rendered in parallel. In case 'tarballs' directory
+    is given, source tarball of each module is created there using pool
+    of 'jobs' workers and its file name and checksum are passed to templates
+    as 'tarball' and 'sha256' of the module. Content of metadata.json
+    of each module is passed to templates as 'metadata' mapping, modules
+    in Puppetfile each module depends on as 'dependencies' mapping.
+    """
+    targets = targets or [(template, output, release)]
     puppetfile = utils.PuppetFile(repo)
     puppetfile.load()
+    lock = utils.LockFile(repo)
+    lock.load()
 
     # fill required metadata to puppetfile
     for module, info in puppetfile.items():
+        # modules pinned to branch names get commit resolved in lock file
+        entry = lock.get(module, info)
+        if entry and 'commit' not in info:
+            info['commit'] = entry['commit']
         info['fullname'] = (
             os.path.basename(info['git']).split('.', 1)[0]
         )
         for key, value in info.items():
             info[key] = unicode(value)
 
-    # get changelog from old spec
-    _locals = locals()
-    rc, stdout, stderr = utils.execute(
-        'tail -n +$('
-            'grep -n -e "^%changelog" {old} | cut -d\':\' -f1'
-        ') {old}'.format(**_locals),
-        can_fail=False
-    )
-    old_changelog = u'' if rc else stdout[len('%changelog'):]
-    old_changelog = old_changelog.decode('utf-8')
+    # get version and dependencies of modules
+    metadata = load_metadata(repo, puppetfile, lock)
+    dependencies = dependency_graph(puppetfile, metadata)
 
-    # get patches from old spec
-    rc, stdout, stderr = utils.execute(
-        'grep "^Patch[0-9]*:" {old}'.format(**_locals),
-        can_fail=False
-    )
-    patches_list = u'' if rc else stdout.decode('utf-8')
+    # create source tarballs of modules
+    if tarballs:
+        archives = build_tarballs(
+            config, repo, puppetfile, lock, tarballs, jobs=jobs
+        )
+        for module, (name, sha256) in archives.items():
+            puppetfile[module]['tarball'] = unicode(name)
+            puppetfile[module]['sha256'] = unicode(sha256)
 
-    rc, stdout, stderr = utils.execute(
-        'grep "^%patch[0-9]*" {old}'.format(**_locals),
-        can_fail=False
-    )
-    patches_apply = u'' if rc else stdout.decode('utf-8')
+    # get changelog and patches from old spec
+    old_spec = utils.SpecFile(old)
+    old_spec.load()
+    old_changelog = old_spec.changelog
+    patches_list = old_spec.patches_list
+    patches_apply = old_spec.patches_apply
 
     # get current date
     current_date = datetime.datetime.today()
 
     # get name and email from git repo
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git config --get user.name && '
-        'git config --get user.email'.format(**_locals)
-    )
-    user_name, user_email = stdout.strip().split('\n', 1)
+    session = git.get_session(repo)
+    user_name = session.config('user.name')
+    user_email = session.config('user.email')
+    if not user_name or not user_email:
+        raise utils.ExecutionError(
+            'Failed to get user.name and user.email from git config',
+            stdout='', stderr=''
+        )
     user_name = user_name.decode('utf-8')
     user_email = user_email.decode('utf-8')
 
-    commit = info['commit'] if 'commit' in info else info['ref']
-
     # generate message for a tag
-    msg = '{0}-{1}\\n'.format(version, release)
+    msg = ''
+    for release in sorted(set(release for _, _, release in targets)):
+        msg += '{0}-{1}\n'.format(version, release)
     for module, info in puppetfile.items():
-        msg += '{0}{1}\\n'.format(
+        commit = info['commit'] if 'commit' in info else info['ref']
+        msg += '{0}{1}\n'.format(
             module, format_rjust(commit, module, 10)
         )
 
-    # generate spec file
+    # generate spec files
     _locals = locals()
-    template_obj = jinja_env.get_template(template)
-    with codecs.open(os.path.abspath(output), 'wb', 'utf-8') as ofile:
-        ofile.write(template_obj.render(**_locals))
+    for template, output, release in targets:
+        utils.shout(
+            'Generating SPEC file {0} from template {1}'.format(
+                output, template
+            ),
+            verbose=config.verbose,
+            level='info'
+        )
+    results = utils.parallel(
+        lambda target: render_target(_locals, *target),
+        targets, jobs=len(targets)
+    )
+    for (template, output, release), written, error in results:
+        if error is not None:
+            raise error
+        if not written:
+            utils.shout(
+                'SPEC file {0} has not changed'.format(output),
+                verbose=config.verbose,
+                level='info'
+            )
 
     # tag repo
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git tag -a -m $\'{msg}\' {version}'.format(**_locals)
+    rc, stdout, stderr = utils.run(
+        ['git', 'tag', '-a', '-m', msg, version], workdir=repo
     )
     utils.shout(
         'New tag {version} has been created in repo. Please run '
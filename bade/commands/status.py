@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from .. import git
+from .. import utils
+from . import init
+
+
+def head_trees(repo):
+    """Returns {directory: tree hash} of top level directories in HEAD."""
+    rc, stdout, stderr = utils.run(
+        ['git', 'ls-tree', '-z', 'HEAD'], workdir=repo, can_fail=False
+    )
+    trees = {}
+    if rc:
+        # repo without commits
+        return trees
+    for entry in stdout.split('\0'):
+        if not entry:
+            continue
+        meta, path = entry.split('\t', 1)
+        mode, kind, sha = meta.split()
+        if kind == 'tree':
+            trees[path] = sha
+    return trees
+
+
+def changed_directories(repo):
+    """Returns set of top level directories which contain changes in index
+    or working tree (including untracked files) compared to HEAD.
+    """
+    rc, stdout, stderr = utils.run(
+        ['git', '--no-optional-locks', 'status', '--porcelain', '-z',
+         '--no-renames', '--untracked-files=normal'],
+        workdir=repo
+    )
+    changed = set()
+    for entry in stdout.split('\0'):
+        path = entry[3:]
+        if '/' in path:
+            changed.add(path.split('/', 1)[0])
+    return changed
+
+
+def module_refs(repo, branch):
+    """Returns set of modules which have module ref for 'branch'."""
+    prefix = init.module_ref(branch, '')
+    modules = set()
+    rc, stdout, stderr = utils.run(
+        ['git', 'for-each-ref', '--format=%(refname)', prefix],
+        workdir=repo,
+        stream=lambda line: modules.add(line.rstrip('\n')[len(prefix):])
+    )
+    return modules
+
+
+def expected_tree(repo, module, info, lock):
+    """Returns hash of the tree module's directory should have according
+    to Puppetfile.lock or to the commit pinned in Puppetfile. Returns None
+    if neither is available locally.
+    """
+    entry = lock.get(module, info)
+    if entry:
+        return entry['tree']
+    commit, is_hash = init.pinned_commit(info)
+    if not is_hash:
+        return None
+    return git.get_session(repo).tree(commit)
+
+
+def command(config, repo, worktree=False):
+    """Compares tree of each module's directory in HEAD (and in working
+    tree and index if 'worktree' is True) with tree of the commit pinned
+    in Puppetfile (or recorded in Puppetfile.lock). Directories of modules
+    which are not in Puppetfile anymore, but still have module ref or lock
+    entry, are reported as orphaned. Number of spawned git processes does
+    not depend on number of modules. Returns list of (module, state)
+    tuples of modules which do not match.
+    """
+    puppetfile = utils.PuppetFile(repo)
+    puppetfile.load()
+    lock = utils.LockFile(repo)
+    lock.load()
+    branch = utils.get_current_branch(repo)
+    trees = head_trees(repo)
+    changed = changed_directories(repo) if worktree else set()
+
+    problems = []
+    for module in sorted(puppetfile.keys()):
+        info = puppetfile[module]
+        expected = expected_tree(repo, module, info, lock)
+        if module not in trees:
+            state = 'missing'
+        elif module in changed:
+            state = 'modified'
+        elif expected is None:
+            state = 'unresolved'
+        elif trees[module] != expected:
+            state = 'drifted'
+        else:
+            utils.shout(
+                'Module {0} matches {1}'.format(
+                    module, init.pinned_commit(info)[0]
+                ),
+                verbose=config.verbose,
+                level='info'
+            )
+            continue
+        problems.append((module, state))
+
+    known = module_refs(repo, branch) | set(lock)
+    for module in sorted(known - set(puppetfile.keys())):
+        if module in trees or (
+                worktree and os.path.isdir(os.path.join(repo, module))):
+            problems.append((module, 'orphaned'))
+
+    messages = {
+        'missing': 'directory is missing in HEAD',
+        'modified': 'directory has uncommitted changes',
+        'unresolved': 'pinned commit is not available locally, run '
+                      '"bade init" to record it in Puppetfile.lock',
+        'drifted': 'tree in HEAD does not match pinned commit',
+        'orphaned': 'module is not in Puppetfile anymore',
+    }
+    for module, state in problems:
+        utils.shout(
+            '{0}: {1} ({2})'.format(module, state, messages[state]),
+            verbose=True,
+            level='warning'
+        )
+    return problems
@@ -2,63 +2,335 @@
 
 import os
 
+from .. import engine
+from .. import git
+from .. import hosts
 from .. import utils
 from . import init
 
 
-def merge_module_branch(repo, branch, module, commit):
-    """Merges new state of module branch to base branch."""
-    rc, stdout, stderr = utils.execute(
-        'cd {repo} && '
-        'git merge -s ours --squash --no-commit {branch}-{module} && '
-        'git read-tree --prefix={module} '
-            '-u {branch}-{module} {commit}'.format(**locals())
+def load_manifest(manifest):
+    """Returns list of (module, commit) pairs from given manifest file
+    object. Each line of manifest contains module name and commit hash
+    separated by whitespace, empty lines and lines starting with '#'
+    are ignored.
+    """
+    updates = []
+    for number, line in enumerate(manifest, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            module, new_commit = line.split()
+        except ValueError:
+            raise ValueError(
+                'Invalid manifest line {0}: {1}'.format(number, line)
+            )
+        updates.append((module, new_commit))
+    return updates
+
+
+def converge(puppetfile, target):
+    """Returns list of (module, commit) pairs which have to be updated
+    so that modules in 'puppetfile' match modules in 'target' Puppetfile.
+    """
+    updates = []
+    for module, info in sorted(target.items()):
+        if module not in puppetfile:
+            utils.shout(
+                'Module {0} is not present in Puppetfile, please use '
+                '"bade add" to add it'.format(module),
+                verbose=True,
+                level='warning'
+            )
+            continue
+        new_commit = info['commit'] if 'commit' in info else info['ref']
+        current = puppetfile[module]
+        old_commit = (
+            current['commit'] if 'commit' in current else current['ref']
+        )
+        if new_commit != old_commit:
+            updates.append((module, new_commit))
+    return updates
+
+
+def commit_branch(repo, branch, tip, modules, puppetfile, lock, msg,
+                  worktree=False):
+    """Creates commit on top of 'tip' of given base 'branch' with given
+    modules imported from their module refs and with given Puppetfile and
+    lock file content. The commit is assembled in temporary index, so the
+    branch does not have to be checked out. In case 'worktree' is True
+    (the branch is checked out), index and working tree are updated
+    to the new commit. Returns hash of the new commit.
+    """
+    with init.temporary_index(repo, branch, tip, worktree=worktree) as env:
+        for module in modules:
+            init.import_module(repo, branch, module, env=env)
+        files = {
+            'Puppetfile': puppetfile.dumps(),
+            'Puppetfile.lock': lock.dumps(),
+        }
+        return init.commit_index(
+            repo, branch, tip, env, files, msg, modules, worktree=worktree
+        )
+
+
+def update_branches(config, repo, updates, branches, jobs=1, checkout=True):
+    """Updates modules given by list of (module, commit) pairs 'updates'
+    on each of given base 'branches'. Each upstream commit is fetched once
+    (using pool of 'jobs' workers) and commit of each branch is created
+    without checking the branch out. Checked out branch is updated from
+    its index and working tree, which are updated too, unless 'checkout'
+    is False. Returns {branch: (commit, error)}
+    mapping, commit is None if the branch was already up to date.
+    """
+    session = git.get_session(repo)
+    updates = sorted(dict(updates).items())
+    results = {}
+    plans = {}
+    fetches = {}
+    for branch in branches:
+        try:
+            worktree = init.uses_worktree(repo, branch, checkout)
+            tip, puppetfile, lock = init.read_branch(
+                repo, branch, worktree=worktree
+            )
+        except utils.ExecutionError as ex:
+            results[branch] = (None, ex)
+            continue
+        missing = [module for module, new_commit in updates
+                   if module not in puppetfile]
+        if missing:
+            results[branch] = (None, ValueError(
+                'Modules not present in Puppetfile: {0}'.format(
+                    ', '.join(missing)
+                )
+            ))
+            continue
+        targets = {}
+        for module, new_commit in updates:
+            info = dict(puppetfile[module])
+            key = 'commit' if 'commit' in info else 'ref'
+            if info[key] == new_commit:
+                continue
+            info[key] = new_commit
+            targets[module] = info
+            # branches sharing upstream and pin share single fetch
+            fetches.setdefault(
+                (module, info['git'], new_commit), []
+            ).append(branch)
+        plans[branch] = (tip, puppetfile, lock, targets, worktree)
+
+    # fetch each upstream commit once to module ref of first branch,
+    # module refs of other branches point to the fetched commit
+    stats = hosts.HostStats()
+    stats.load()
+    runner = engine.Engine(
+        repo, jobs=jobs, remote_jobs=config.host_jobs, hosts=stats
+    )
+
+    def pipeline(key):
+        module = key[0]
+        first = fetches[key][0]
+        info = plans[first][3][module]
+        init.fetch_remote(config, runner, stats, repo, first, module, info)
+        commit = session.resolve(init.module_ref(first, module))
+        for branch in fetches[key][1:]:
+            rc, stdout, stderr = utils.run(
+                ['git', 'update-ref', init.module_ref(branch, module),
+                 commit],
+                workdir=repo
+            )
+
+    keys = stats.order(
+        sorted(fetches), lambda key: engine.remote_key(key[1])
     )
+    try:
+        fetched = runner.run(pipeline, keys)
+    finally:
+        stats.save()
+    errors = {}
+    for key, result, error in fetched:
+        if error is not None:
+            for branch in fetches[key]:
+                errors.setdefault(branch, []).append((key[0], error))
 
+    for branch in branches:
+        if branch not in plans:
+            continue
+        if branch in errors:
+            results[branch] = (None, init.fetch_error(errors[branch]))
+            continue
+        tip, puppetfile, lock, targets, worktree = plans[branch]
+        if not targets:
+            results[branch] = (None, None)
+            continue
+        status = ''
+        for module in sorted(targets):
+            info = puppetfile[module]
+            key = 'commit' if 'commit' in info else 'ref'
+            old_commit = info[key]
+            new_commit = targets[module][key]
+            info[key] = new_commit
+            init.lock_module(repo, branch, module, info, lock)
+            status += (
+                '{module}\n - old commit: {old_commit}\n'
+                    ' - new commit: {new_commit}\n\n'.format(**locals())
+            )
+        try:
+            commit = commit_branch(
+                repo, branch, tip, sorted(targets), puppetfile, lock,
+                utils.COMMIT_MSG.format(status), worktree=worktree
+            )
+        except utils.ExecutionError as ex:
+            results[branch] = (None, ex)
+            continue
+        results[branch] = (commit, None)
+    return results
 
-def command(config, repo, module, new_commit, commit):
-    """Updates git subtree module to given commit and updates Puppetfile."""
+
+def report_branches(results):
+    """Reports results of update_branches() and raises ExecutionError
+    in case update of any branch failed.
+    """
+    failed = []
+    for branch in sorted(results):
+        commit, error = results[branch]
+        if error is not None:
+            failed.append((branch, error))
+            utils.shout(
+                'Failed to update branch {0}: {1}'.format(branch, error),
+                verbose=True,
+                level='error'
+            )
+        elif commit:
+            utils.shout(
+                'Branch {0} updated by commit {1}'.format(branch, commit),
+                verbose=True,
+                level='info'
+            )
+        else:
+            utils.shout(
+                'Branch {0} is up to date'.format(branch),
+                verbose=True,
+                level='info'
+            )
+    if failed:
+        raise utils.ExecutionError(
+            'Failed to update branches: {0}'.format(
+                ', '.join(branch for branch, error in failed)
+            ),
+            stdout='\n'.join(
+                getattr(error, 'stdout', '') for branch, error in failed
+            ),
+            stderr='\n'.join(
+                getattr(error, 'stderr', str(error))
+                for branch, error in failed
+            )
+        )
+
+
+def command(config, repo, updates, commit, jobs=1, branches=None,
+            checkout=True):
+    """Updates git subtree modules to commits given by list of
+    (module, commit) pairs 'updates' and updates Puppetfile. Modules are
+    synchronized using pool of 'jobs' workers, all updates are applied
+    and committed at once. In case list of base 'branches' is given,
+    modules are updated and committed on each of those branches instead
+    of the current one. Commits are assembled in temporary index, index
+    and working tree are updated afterwards. If 'checkout' is False,
+    the commit is assembled from HEAD (including Puppetfile) and index
+    and working tree are left untouched.
+    """
+    if branches:
+        return report_branches(
+            update_branches(
+                config, repo, updates, branches, jobs, checkout=checkout
+            )
+        )
 
     # initialization
-    puppetfile = utils.PuppetFile(repo)
-    puppetfile.load()
-    old_commit = (
-        puppetfile[module]['commit']
-            if 'commit' in puppetfile[module] else
-        puppetfile[module]['ref']
-    )
     branch = utils.get_current_branch(repo)
-    _locals = locals()
+    worktree = not commit or init.uses_worktree(repo, branch, checkout)
+    tip, puppetfile, lock = init.read_branch(repo, branch, worktree=worktree)
+    for module, new_commit in updates:
+        if module not in puppetfile:
+            raise ValueError(
+                'Module {0} is not present in Puppetfile'.format(module)
+            )
+    updates = [
+        (module, new_commit)
+        for module, new_commit in sorted(dict(updates).items())
+        if new_commit not in (puppetfile[module].get('commit'),
+                              puppetfile[module].get('ref'))
+    ]
+    if not updates:
+        utils.shout(
+            'All modules are up to date',
+            verbose=True,
+            level='info'
+        )
+        return
+    modules = [module for module, new_commit in updates]
+    targets = {}
+    for module, new_commit in updates:
+        info = dict(puppetfile[module])
+        info['commit' if 'commit' in info else 'ref'] = new_commit
+        targets[module] = info
 
-    utils.shout(
-        'Updating module {module} for branch {branch} '
-            'in {repo}'.format(**_locals),
-        verbose=config.verbose,
-        level='info'
-    )
+    # updates module branches and base branch
+    status = {}
 
-    # updates module branch and base branch
-    init.create_module_branch(repo, branch, module, puppetfile[module])
-    merge_module_branch(repo, branch, module, new_commit)
-    # updates Puppetfile
-    key = 'commit' if 'commit' in puppetfile[module] else 'ref'
-    puppetfile[module][key] = new_commit
-    puppetfile.save()
+    def imported(module):
+        info = puppetfile[module]
+        key = 'commit' if 'commit' in info else 'ref'
+        old_commit = info[key]
+        new_commit = targets[module][key]
+        info[key] = new_commit
+        init.lock_module(repo, branch, module, info, lock)
+        status[module] = (
+            '{module}\n - old commit: {old_commit}\n'
+                ' - new commit: {new_commit}\n\n'.format(**locals())
+        )
 
-    if commit:
+    for module in modules:
         utils.shout(
-            'Generating commit',
+            'Updating module {module} for branch {branch} '
+                'in {repo}'.format(**locals()),
             verbose=config.verbose,
             level='info'
         )
-        status = (
-            '{module}\\n - old commit: {old_commit}\\n'
-                ' - new commit: {new_commit}\\n\\n'.format(**_locals)
+    if not commit:
+        failed = init.sync_modules(
+            config, repo, branch, targets, modules, jobs=jobs,
+            imported=imported
+        )
+        # modules which were imported are recorded even if others failed,
+        # so that Puppetfile matches content of the base branch
+        puppetfile.save()
+        lock.save()
+        if failed:
+            raise init.fetch_error(failed)
+        return
+
+    with init.temporary_index(repo, branch, tip, worktree=worktree) as env:
+        failed = init.sync_modules(
+            config, repo, branch, targets, modules, jobs=jobs,
+            imported=imported, env=env
+        )
+        if failed:
+            raise init.fetch_error(failed)
+        utils.shout(
+            'Generating commit',
+            verbose=config.verbose,
+            level='info'
         )
-        _locals['msg'] = utils.COMMIT_MSG.format(status)
-        rc, stdout, stderr = utils.execute(
-            'cd {repo} && '
-            'git add Puppetfile && '
-            'git add {module} --ignore-errors && '
-            'git commit -m $\'{msg}\''.format(**_locals)
+        status = ''.join(status[module] for module in sorted(status))
+        files = {
+            'Puppetfile': puppetfile.dumps(),
+            'Puppetfile.lock': lock.dumps(),
+        }
+        init.commit_index(
+            repo, branch, tip, env, files, utils.COMMIT_MSG.format(status),
+            modules, worktree=worktree
         )
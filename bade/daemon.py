@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+import click
+import json
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+import traceback
+
+from . import git
+from . import utils
+
+
+SOCKET = os.path.join(os.path.expanduser('~'), '.bade', 'bade.sock')
+COMMANDS = ('init', 'update', 'spec', 'clean')
+
+
+class Channel(object):
+    """File-like object sending written output to client as JSON lines."""
+
+    def __init__(self, sock):
+        self._file = sock.makefile('wb', 0)
+        self._lock = threading.Lock()
+
+    def send(self, **message):
+        with self._lock:
+            self._file.write(json.dumps(message) + '\n')
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        self.send(output=data)
+
+    def flush(self):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Unix socket server running bade jobs. Each connection carries one
+    job given as JSON line {"command", "repo", "config", "params"}. Output
+    of the job is sent back as {"output": text} lines followed by
+    {"exit": code}. Jobs for the same repo are queued, jobs for different
+    repos run concurrently. Git query sessions, mirror sessions, parsed
+    Puppetfiles and compiled templates live as long as the server.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.path = path
+        self._queues = {}
+        self._lock = threading.Lock()
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+
+    def queue(self, repo):
+        """Returns lock which jobs of given repo have to hold."""
+        with self._lock:
+            return self._queues.setdefault(repo, threading.Lock())
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        channel = Channel(self.request)
+        try:
+            job = json.loads(self.rfile.readline())
+            if job.get('command') not in COMMANDS:
+                raise ValueError(
+                    'Unsupported command: {0}'.format(job.get('command'))
+                )
+        except ValueError as ex:
+            channel.send(output=u'[error] {0}\n'.format(ex))
+            channel.send(exit=2)
+            return
+        repo = os.path.abspath(native(job['repo']))
+        with self.server.queue(repo):
+            channel.send(exit=run_job(job, repo, channel))
+
+
+def native(value):
+    """Returns given JSON value with unicode strings encoded to str,
+    so that jobs get the same arguments as when run from command line.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [native(item) for item in value]
+    if isinstance(value, dict):
+        return dict((native(key), native(item))
+                    for key, item in value.items())
+    return value
+
+
+def run_job(job, repo, stream):
+    """Runs given job writing its output to 'stream'. Returns exit code."""
+    # imported here, bade.bade forwards jobs to the daemon
+    from . import commands
+    from .bade import Config
+
+    config = Config()
+    for key, value in native(job.get('config', {})).items():
+        setattr(config, key, value)
+    params = native(job.get('params', {}))
+    utils.OUTPUT.stream = stream
+    try:
+        # git config or HEAD might have been changed since last job
+        git.get_session(repo).invalidate()
+        commands.load(job['command']).command(config, repo, **params)
+        return 0
+    except utils.ExecutionError as ex:
+        utils.shout(ex, verbose=True, level='error')
+        utils.shout(
+            '====== stdout ======\n{stdout}\n'
+            '====== stderr ======\n{stderr}'.format(**ex.__dict__),
+            verbose=config.verbose,
+            level=None,
+        )
+    except Exception as ex:
+        utils.shout(ex, verbose=True, level='error')
+        if config.verbose:
+            utils.shout(traceback.format_exc(), verbose=True, level=None)
+    finally:
+        utils.OUTPUT.stream = None
+    return 1
+
+
+def serve(path=SOCKET):
+    """Serves jobs on unix socket 'path' until interrupted."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    if os.path.exists(path):
+        sock = connect(path)
+        if sock:
+            sock.close()
+            raise utils.ExecutionError(
+                'Bade daemon is already running on {0}'.format(path),
+                stdout='', stderr=''
+            )
+        # stale socket of terminated daemon
+        os.unlink(path)
+    server = Server(path)
+    os.chmod(path, 0o600)
+    # remove the socket also when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def connect(path=SOCKET):
+    """Returns socket connected to daemon or None if it is not running."""
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def forward(config, command, repo, **params):
+    """Sends job to running daemon and prints its output. Returns exit code
+    of the job or None if the daemon is not running (or use of the daemon
+    is disabled), in which case the job has to be run locally.
+    """
+    if not config.daemon_socket:
+        return None
+    sock = connect(config.daemon_socket)
+    if sock is None:
+        return None
+    job = {
+        'command': command,
+        'repo': os.path.abspath(repo),
+        'config': {
+            'verbose': config.verbose,
+            'mirror_dir': config.mirror_dir,
+            'fetch': config.fetch,
+            'host_jobs': config.host_jobs,
+        },
+        'params': params,
+    }
+    try:
+        sock.sendall(json.dumps(job) + '\n')
+        for line in iter(sock.makefile('rb').readline, ''):
+            message = json.loads(line)
+            if 'output' in message:
+                click.echo(message['output'], nl=False)
+            elif 'exit' in message:
+                return message['exit']
+    finally:
+        sock.close()
+    raise utils.ExecutionError(
+        'Bade daemon terminated connection unexpectedly',
+        stdout='', stderr=''
+    )
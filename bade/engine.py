@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import re
+import threading
+import urlparse
+
+from . import git
+from . import utils
+
+
+REMOTE_JOBS = 4
+RE_SCP_URL = re.compile(r'^(?:[^@/]+@)?([^:/]+):(?!//)')
+
+
+def remote_key(url):
+    """Returns key of remote host of given git URL. All local repos
+    share key 'local'.
+    """
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme and parsed.netloc:
+        return parsed.hostname or parsed.netloc
+    match = RE_SCP_URL.match(url)
+    if match and not parsed.scheme == 'file':
+        return match.group(1)
+    return 'local'
+
+
+class Engine(object):
+    """Runs per-module pipelines concurrently in one repo using pool
+    of 'jobs' threads. Pipelines declare which steps need exclusive
+    access to shared resources:
+
+    - remote(url) limits number of concurrent network operations against
+      one remote host to 'remote_jobs' (or to limit of the host in 'hosts'
+      statistics)
+    - index() serializes steps mutating git config, index or working tree
+      of the repo
+    - ordered() in addition runs the step in the order in which items were
+      given, so that results (imports, Puppetfile changes) do not depend on
+      timing of network operations
+
+    Other steps (fetching, resolving, verifying) run concurrently.
+    """
+
+    def __init__(self, repo, jobs=1, remote_jobs=REMOTE_JOBS, hosts=None):
+        self.repo = repo
+        self.jobs = jobs
+        self.remote_jobs = remote_jobs
+        self.hosts = hosts
+        self._lock = threading.Lock()
+        self._turn = threading.Condition(self._lock)
+        self._remotes = {}
+        self._local = threading.local()
+        self._next = 0
+        self._finished = set()
+
+    def remote(self, url):
+        """Returns semaphore limiting concurrent operations against remote
+        host of given URL.
+        """
+        key = remote_key(url)
+        with self._lock:
+            if key not in self._remotes:
+                limit = self.remote_jobs
+                if self.hosts:
+                    limit = self.hosts.limit(key, limit)
+                self._remotes[key] = threading.BoundedSemaphore(
+                    max(limit, 1)
+                )
+            return self._remotes[key]
+
+    def index(self):
+        """Returns lock of repo's index and working tree."""
+        return git.index_lock(self.repo)
+
+    @contextlib.contextmanager
+    def ordered(self):
+        """Holds index lock once all items given before the current one
+        have finished their ordered step (or failed).
+        """
+        position = self._local.position
+        with self._turn:
+            while self._next != position:
+                self._turn.wait()
+        try:
+            with self.index():
+                yield
+        finally:
+            self._finish(position)
+
+    def _finish(self, position):
+        with self._turn:
+            self._finished.add(position)
+            while self._next in self._finished:
+                self._next += 1
+            self._turn.notify_all()
+
+    def run(self, pipeline, items):
+        """Runs callable 'pipeline' for each of given items. Returns list
+        of (item, result, exception) tuples in the order of given items.
+        """
+        items = list(items)
+        self._next = 0
+        self._finished = set()
+
+        def call(args):
+            position, item = args
+            self._local.position = position
+            try:
+                return pipeline(item)
+            finally:
+                # item which failed before reaching its ordered step must
+                # not block items following it
+                self._finish(position)
+
+        results = utils.parallel(call, enumerate(items), jobs=self.jobs)
+        return [
+            (item, result, error)
+            for (position, item), result, error in results
+        ]
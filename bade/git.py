@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import os
+import re
+import subprocess
+import threading
+
+from . import utils
+
+
+RE_SHA = re.compile(r'^[0-9a-f]{40}$')
+RE_CONFIG_SECTION = re.compile(
+    r'^\s*\[\s*([A-Za-z0-9.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]'
+)
+
+
+class Session(object):
+    """Long-lived git query session for given repo. Object lookups are
+    answered by persistent 'git cat-file --batch-check' and
+    'git cat-file --batch' processes, so that no new process has to be
+    spawned for each question. Results which can not change (trees of given
+    commit hashes) are cached for the lifetime of the session.
+    """
+
+    def __init__(self, repo):
+        self.repo = os.path.abspath(repo)
+        self._lock = threading.RLock()
+        self._procs = {}
+        self._trees = {}
+        self._git_dir = None
+        self._config = None
+
+    def _process(self, mode):
+        proc = self._procs.get(mode)
+        if proc is None or proc.poll() is not None:
+            utils.LOG.debug(
+                'Starting git cat-file --{0} in {1}'.format(mode, self.repo)
+            )
+            proc = subprocess.Popen(
+                ['git', 'cat-file', '--{0}'.format(mode)],
+                cwd=self.repo, close_fds=True,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            self._procs[mode] = proc
+        return proc
+
+    def _query(self, mode, name):
+        """Sends object 'name' to cat-file process and returns tuple
+        (process, hash, type, size) or None if object does not exist.
+        """
+        if '\n' in name:
+            raise ValueError('Invalid object name: {0!r}'.format(name))
+        proc = self._process(mode)
+        proc.stdin.write('{0}\n'.format(name))
+        proc.stdin.flush()
+        header = proc.stdout.readline()
+        if not header:
+            raise utils.ExecutionError(
+                'git cat-file --{0} terminated unexpectedly'.format(mode),
+                stdout='', stderr=''
+            )
+        parts = header.split()
+        if len(parts) != 3:
+            # "<name> missing" or "<name> ambiguous"
+            return None
+        return proc, parts[0], parts[1], int(parts[2])
+
+    def check(self, name):
+        """Returns tuple (hash, type, size) of object given by 'name'
+        or None if such object does not exist.
+        """
+        with self._lock:
+            result = self._query('batch-check', name)
+        return result[1:] if result else None
+
+    def resolve(self, name):
+        """Returns hash of object given by 'name' (ref, revision expression,
+        abbreviated hash, etc.) or None if such object does not exist.
+        """
+        result = self.check(name)
+        return result[0] if result else None
+
+    def read(self, name):
+        """Returns tuple (hash, type, content) of object given by 'name'
+        or None if such object does not exist.
+        """
+        with self._lock:
+            result = self._query('batch', name)
+            if not result:
+                return None
+            proc, sha, kind, size = result
+            content = proc.stdout.read(size)
+            proc.stdout.read(1)
+        return sha, kind, content
+
+    def tree(self, commit, prefix=None):
+        """Returns hash of tree object of given 'commit' or hash of subtree
+        on given 'prefix' of the commit. Returns None in case the object does
+        not exist. Results for full commit hashes are cached.
+        """
+        key = (commit, prefix)
+        if RE_SHA.match(commit) and key in self._trees:
+            return self._trees[key]
+        name = (
+            '{commit}:{prefix}' if prefix else '{commit}^{{tree}}'
+        ).format(**locals())
+        result = self.check(name)
+        if not result or result[1] != 'tree':
+            return None
+        if RE_SHA.match(commit):
+            self._trees[key] = result[0]
+        return result[0]
+
+    def git_dir(self):
+        """Returns absolute path to git directory of the repo."""
+        if self._git_dir is None:
+            rc, stdout, stderr = utils.run(
+                ['git', 'rev-parse', '--git-dir'], workdir=self.repo
+            )
+            self._git_dir = os.path.join(self.repo, stdout.strip())
+        return self._git_dir
+
+    def current_branch(self):
+        """Returns name of currently checked out branch."""
+        with open(os.path.join(self.git_dir(), 'HEAD')) as head:
+            content = head.read().strip()
+        if not content.startswith('ref: refs/heads/'):
+            raise utils.ExecutionError(
+                'Impossible to find current branch, HEAD is detached',
+                stdout=content, stderr=''
+            )
+        return content[len('ref: refs/heads/'):]
+
+    def config(self, key, default=None):
+        """Returns value of given git config 'key'. Whole config is loaded
+        at first call and cached until invalidate() is called.
+        """
+        if self._config is None:
+            rc, stdout, stderr = utils.run(
+                ['git', 'config', '--list', '-z'], workdir=self.repo
+            )
+            config = {}
+            for item in stdout.split('\0'):
+                if not item:
+                    continue
+                name, _, value = item.partition('\n')
+                config[name.lower()] = value
+            self._config = config
+        return self._config.get(key.lower(), default)
+
+    def invalidate(self):
+        """Drops cached results which might change in time."""
+        self._config = None
+
+    def close(self):
+        """Terminates all cat-file processes of this session."""
+        with self._lock:
+            for proc in self._procs.values():
+                if proc.poll() is None:
+                    proc.stdin.close()
+                    proc.wait()
+            self._procs.clear()
+
+
+def remove_config_sections(repo, sections):
+    """Removes given (section, subsection) pairs from config of given repo
+    in a single edit guarded by config.lock, the same way git does it.
+    Returns set of pairs which were found and removed.
+    """
+    session = get_session(repo)
+    path = os.path.join(session.git_dir(), 'config')
+    lock_path = '{0}.lock'.format(path)
+    wanted = set(
+        (section.lower(), subsection) for section, subsection in sections
+    )
+    try:
+        fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except OSError as ex:
+        raise utils.ExecutionError(
+            'Unable to lock {0}: {1}'.format(path, ex.strerror),
+            stdout='', stderr=str(ex)
+        )
+    removed = set()
+    try:
+        with open(path) as config:
+            lines = config.readlines()
+        content = []
+        skip = False
+        for line in lines:
+            match = RE_CONFIG_SECTION.match(line)
+            if match:
+                key = (match.group(1).lower(), match.group(2))
+                skip = key in wanted
+                if skip:
+                    removed.add(key)
+            if not skip:
+                content.append(line)
+        with os.fdopen(fd, 'w') as lock:
+            fd = None
+            lock.write(''.join(content))
+            lock.flush()
+            os.fsync(lock.fileno())
+        os.chmod(lock_path, os.stat(path).st_mode & 0o7777)
+        os.rename(lock_path, path)
+    except Exception:
+        if fd is not None:
+            os.close(fd)
+        if os.path.exists(lock_path):
+            os.unlink(lock_path)
+        raise
+    session.invalidate()
+    return removed
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_repo_locks = {}
+_index_locks = {}
+
+
+def get_session(repo):
+    """Returns shared query session for given repo."""
+    path = os.path.abspath(repo)
+    with _sessions_lock:
+        if path not in _sessions:
+            _sessions[path] = Session(path)
+        return _sessions[path]
+
+
+def repo_lock(repo):
+    """Returns lock shared by all threads working with given repo. It
+    should be held by operations which can not run concurrently in one
+    repo (for example shallow fetches, which rewrite .git/shallow).
+    """
+    path = os.path.abspath(repo)
+    with _sessions_lock:
+        return _repo_locks.setdefault(path, threading.Lock())
+
+
+def index_lock(repo):
+    """Returns reentrant lock shared by all threads working with given
+    repo, which has to be held by operations changing git config, index
+    or working tree of the repo.
+    """
+    path = os.path.abspath(repo)
+    with _sessions_lock:
+        return _index_locks.setdefault(path, threading.RLock())
+
+
+@atexit.register
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
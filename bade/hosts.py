@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import json
+import os
+import threading
+
+from . import mirror
+from . import utils
+
+
+HOSTS_FILE = os.path.join(os.path.expanduser('~'), '.bade', 'hosts.json')
+
+
+class HostStats(object):
+    """Fetch statistics of upstream hosts persisted between runs in
+    'path'. For each host it keeps number of fetches, failures and total
+    time spent fetching. Optional 'limit' of concurrent fetches can be set
+    per host in the file by hand.
+    """
+
+    def __init__(self, path=HOSTS_FILE):
+        self._fpath = path
+        self._hosts = {}
+        self._new = collections.defaultdict(
+            lambda: {'fetches': 0, 'failures': 0, 'seconds': 0.0}
+        )
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Loads statistics if the file exists."""
+        self._hosts = self._read()
+
+    def _read(self):
+        if not self._fpath or not os.path.exists(self._fpath):
+            return {}
+        try:
+            with open(self._fpath) as stats:
+                return json.load(stats).get('hosts', {})
+        except ValueError as ex:
+            utils.LOG.warning(
+                'Ignoring invalid host statistics {0}: {1}'.format(
+                    self._fpath, ex
+                )
+            )
+            return {}
+
+    def average(self, host):
+        """Returns average duration of successful fetch from given host
+        or None if there is no record of such fetch.
+        """
+        stats = self._hosts.get(host, {})
+        done = stats.get('fetches', 0) - stats.get('failures', 0)
+        if done <= 0:
+            return None
+        return stats.get('seconds', 0.0) / done
+
+    def limit(self, host, default):
+        """Returns maximal number of concurrent fetches from given host."""
+        return max(int(self._hosts.get(host, {}).get('limit', default)), 1)
+
+    def record(self, host, seconds, failed=False):
+        """Records fetch from given host which took 'seconds'."""
+        with self._lock:
+            stats = self._new[host]
+            stats['fetches'] += 1
+            stats['seconds'] += seconds
+            if failed:
+                stats['failures'] += 1
+
+    def order(self, items, host):
+        """Returns given items reordered so that items of hosts which were
+        slowest so far (or which have not been measured yet) go first and
+        items of different hosts alternate. Callable 'host' returns host
+        of given item.
+        """
+        groups = collections.OrderedDict()
+        for item in items:
+            groups.setdefault(host(item), []).append(item)
+
+        def slowness(key):
+            average = self.average(key)
+            return -(float('inf') if average is None else average)
+
+        queues = [groups[key] for key in sorted(groups, key=slowness)]
+        ordered = []
+        while queues:
+            for queue in queues:
+                ordered.append(queue.pop(0))
+            queues = [queue for queue in queues if queue]
+        return ordered
+
+    def save(self):
+        """Merges statistics recorded in this run to the file."""
+        if not self._fpath or not self._new:
+            return
+        directory = os.path.dirname(self._fpath)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with mirror.locked(self._fpath):
+            hosts = self._read()
+            for host, new in self._new.items():
+                stats = hosts.setdefault(host, {})
+                for key, value in new.items():
+                    stats[key] = stats.get(key, 0) + value
+            content = json.dumps(
+                {'hosts': hosts}, indent=2, sort_keys=True,
+                separators=(',', ': ')
+            ) + '\n'
+            with open('{0}.tmp'.format(self._fpath), 'w') as stats:
+                stats.write(content)
+            os.rename('{0}.tmp'.format(self._fpath), self._fpath)
+        self._hosts = hosts
+        self._new.clear()
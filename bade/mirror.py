@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import fcntl
+import hashlib
+import os
+
+from . import utils
+
+
+MIRROR_DIR = os.path.join(os.path.expanduser('~'), '.bade', 'mirrors')
+
+
+def mirror_path(url, mirror_dir=None):
+    """Returns path to local bare mirror of upstream repo given by 'url'."""
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(mirror_dir or MIRROR_DIR, '{0}.git'.format(key))
+
+
+@contextlib.contextmanager
+def locked(path):
+    """Holds exclusive lock of given mirror, so that mirror is not updated
+    by several bade processes at the same time.
+    """
+    with open('{0}.lock'.format(path), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield path
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def ensure(url, mirror_dir=None):
+    """Creates bare mirror repo for upstream 'url' if it does not exist yet
+    and returns path to it.
+    """
+    path = mirror_path(url, mirror_dir)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # created by concurrent fetch
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+    with locked(path):
+        if os.path.exists(os.path.join(path, 'HEAD')):
+            return path
+        rc, stdout, stderr = utils.run(
+            ['git', 'init', '--quiet', '--bare', path]
+        )
+        for args in (['remote.origin.url', url],
+                     ['remote.origin.fetch', '+refs/heads/*:refs/heads/*'],
+                     ['--add', 'remote.origin.fetch',
+                      '+refs/tags/*:refs/tags/*']):
+            rc, stdout, stderr = utils.run(
+                ['git', 'config'] + args, workdir=path
+            )
+    return path
+
+
+def is_shallow(path):
+    """Returns True if mirror repo at 'path' has shallow history."""
+    return os.path.exists(os.path.join(path, 'shallow'))
+
+
+def sync(url, mirror_dir=None, refspecs=None, depth=None):
+    """Fetches new objects from upstream 'url' to the local mirror
+    and returns path to it. Only given 'refspecs' are fetched if 'depth'
+    is given, otherwise all branches and tags are fetched with full history.
+    """
+    path = ensure(url, mirror_dir)
+    if depth:
+        cmd = ['git', 'fetch', '--depth', str(depth), 'origin'] + refspecs
+    elif is_shallow(path):
+        cmd = ['git', 'fetch', '--prune', '--unshallow', 'origin']
+    else:
+        cmd = ['git', 'fetch', '--prune', 'origin']
+    with locked(path):
+        rc, stdout, stderr = utils.run(cmd, workdir=path)
+    return path
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import contextlib
+import functools
+import inspect
+import json
+import threading
+import time
+
+
+class Tracer(object):
+    """Collects spans of commands, module steps and subprocesses. Finished
+    spans are written to given trace file as JSON lines. Attributes 'module'
+    and 'branch' are inherited by nested spans in the same thread.
+    """
+
+    def __init__(self, path=None):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._file = open(path, 'a') if path else None
+
+    def _context(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = [{}]
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, kind, name, **attrs):
+        stack = self._context()
+        context = dict(stack[-1])
+        context.update(
+            (key, value) for key, value in attrs.items()
+            if key in ('module', 'branch') and value is not None
+        )
+        record = dict(attrs)
+        record.update(context)
+        record.update(kind=kind, name=name, start=time.time())
+        stack.append(context)
+        try:
+            yield record
+        except Exception as ex:
+            record['error'] = str(ex)
+            raise
+        finally:
+            stack.pop()
+            record['duration'] = time.time() - record['start']
+            self._emit(record)
+
+    def add(self, kind, name, start, **attrs):
+        """Records already finished span which started at 'start'."""
+        record = dict(attrs)
+        record.update(self._context()[-1])
+        record.update(
+            kind=kind, name=name, start=start, duration=time.time() - start
+        )
+        self._emit(record)
+
+    def _emit(self, record):
+        with self._lock:
+            self.spans.append(record)
+            if self._file:
+                self._file.write(json.dumps(record, sort_keys=True) + '\n')
+                self._file.flush()
+
+    def summary(self, top=10):
+        """Returns table of slowest modules and git operations."""
+        modules = collections.defaultdict(float)
+        operations = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        for record in self.spans:
+            if record['kind'] == 'step' and record.get('module'):
+                modules[record['module']] += record['duration']
+            elif record['kind'] == 'subprocess':
+                stats = operations[record['name']]
+                stats[0] += 1
+                stats[1] += record['duration']
+                stats[2] = max(stats[2], record['duration'])
+
+        lines = ['{0:<40}{1:>12}'.format('Slowest modules', 'total [s]')]
+        for module, total in sorted(
+                modules.items(), key=lambda item: -item[1])[:top]:
+            lines.append('{0:<40}{1:>12.3f}'.format(module, total))
+        lines.append('')
+        lines.append('{0:<40}{1:>8}{2:>12}{3:>12}'.format(
+            'Slowest operations', 'count', 'total [s]', 'max [s]'
+        ))
+        for name, stats in sorted(
+                operations.items(), key=lambda item: -item[1][1])[:top]:
+            lines.append('{0:<40}{1:>8}{2:>12.3f}{3:>12.3f}'.format(
+                name, *stats
+            ))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+_tracer = None
+
+
+def enable(path=None):
+    """Starts collecting spans, optionally writing them to 'path'."""
+    global _tracer
+    _tracer = Tracer(path)
+    return _tracer
+
+
+def disable():
+    """Stops collecting spans and returns the finished tracer."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer:
+        tracer.close()
+    return tracer
+
+
+@contextlib.contextmanager
+def _noop():
+    yield {}
+
+
+def span(kind, name, **attrs):
+    """Returns context manager measuring span of given kind. The yielded
+    record can be updated with additional attributes (exit code, etc.).
+    Does nothing if tracing is not enabled.
+    """
+    if _tracer is None:
+        return _noop()
+    return _tracer.span(kind, name, **attrs)
+
+
+def add(kind, name, start, **attrs):
+    """Records finished span of given kind if tracing is enabled."""
+    if _tracer is not None:
+        _tracer.add(kind, name, start, **attrs)
+
+
+def step(name):
+    """Decorator which records module step span for decorated function.
+    Attributes 'module' and 'branch' are taken from function arguments.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            callargs = inspect.getcallargs(func, *args, **kwargs)
+            with span('step', name,
+                      module=callargs.get('module'),
+                      branch=callargs.get('branch')):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,23 +1,35 @@
 # -*- coding: utf-8 -*-
 
 import click
+import codecs
+import collections
+import json
 import logging
 import os
 import pipes
+import random
 import re
 import subprocess
+import sys
+import threading
 import time
 import types
 
+from . import tracing
+
 
 LOG = logging.getLogger('bade')
+OUTPUT_LIMIT = 64 * 1024
+PARSE_CACHE_SIZE = 8
+# per-thread redirection of shout() output (used by daemon jobs)
+OUTPUT = threading.local()
 COMMIT_MSG = (
-    'Automatic update\\n'
-    '\\n'
-    'This module update commit was generated by Bade.\\n'
-    'For more info please check https://github.com/paramite/bade\\n'
-    '\\n'
-    'This commit is setting modules to following state:\\n'
+    'Automatic update\n'
+    '\n'
+    'This module update commit was generated by Bade.\n'
+    'For more info please check https://github.com/paramite/bade\n'
+    '\n'
+    'This commit is setting modules to following state:\n'
     '{0}'
 )
 
@@ -29,37 +41,161 @@ class ExecutionError(RuntimeError):
         super(ExecutionError, self).__init__(*args, **kwargs)
 
 
-# taken from Kanzo (https://github.com/paramite/kanzo) and simplified
-def execute(cmd, workdir=None, can_fail=True, log=True):
+class Tail(object):
+    """File-like buffer which keeps only last 'limit' bytes written
+    to it.
     """
-    Runs shell command cmd. If can_fail is set to True RuntimeError
-    is raised if command returned non-zero return code. Otherwise
-    returns return code and content of stdout and content of stderr.
+    def __init__(self, limit=OUTPUT_LIMIT):
+        self.limit = limit
+        self.size = 0
+        self._data = ''
+
+    def write(self, data):
+        self.size += len(data)
+        self._data += data
+        if len(self._data) > 2 * self.limit:
+            self._data = self._data[-self.limit:]
+
+    def getvalue(self):
+        return self._data[-self.limit:]
+
+
+def _pump(source, sink):
+    for chunk in iter(lambda: source.read(4096), ''):
+        sink.write(chunk)
+    source.close()
+
+
+def _feed(target, data):
+    try:
+        target.write(data)
+    finally:
+        target.close()
+
+
+def _format_cmd(cmd):
+    return ' '.join(pipes.quote(arg) for arg in cmd)
+
+
+def _operation(cmd):
+    """Returns name of operation run by given command for tracing."""
+    if os.path.basename(cmd[0]) == 'git':
+        for arg in cmd[1:]:
+            if not arg.startswith('-'):
+                return 'git {0}'.format(arg)
+    return os.path.basename(cmd[0])
+
+
+def _spawn(cmd, workdir, input, env, limit, log):
+    """Starts command given as list of arguments and threads feeding its
+    stdin and collecting its stderr.
     """
-    log_msg = 'Executing command: %s' % cmd
     if log:
-        LOG.debug(log_msg)
-
+        LOG.debug('Executing command: %s' % _format_cmd(cmd))
+    if env is not None:
+        env = dict(os.environ, **env)
     proc = subprocess.Popen(
-        cmd, cwd=workdir, shell=True, close_fds=True,
+        cmd, cwd=workdir, close_fds=True, env=env,
+        stdin=subprocess.PIPE if input is not None else None,
         stdout=subprocess.PIPE, stderr=subprocess.PIPE
     )
-    out, err = proc.communicate()
+    err = Tail(limit)
+    threads = [threading.Thread(target=_pump, args=(proc.stderr, err))]
+    if input is not None:
+        threads.append(
+            threading.Thread(target=_feed, args=(proc.stdin, input))
+        )
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return proc, err, threads
+
 
-    if proc.returncode and can_fail:
-        raise ExecutionError('Failed to execute command: %s' % cmd,
-                             stdout=out, stderr=err)
-    return proc.returncode, out, err
+def _finish(proc, threads):
+    for chunk in iter(lambda: proc.stdout.read(4096), ''):
+        pass
+    proc.stdout.close()
+    for thread in threads:
+        thread.join()
+    return proc.wait()
+
+
+def run(cmd, workdir=None, can_fail=True, log=True, stream=None,
+        input=None, env=None, limit=OUTPUT_LIMIT):
+    """
+    Runs command given as list of arguments without shell. If 'stream'
+    callable is given it is called for each line of stdout and only last
+    'limit' bytes of stdout are kept in memory. Only last 'limit' bytes
+    of stderr are kept in any case. Optional 'input' is written to stdin
+    of the command. If can_fail is set to True ExecutionError is raised
+    if command returned non-zero return code. Otherwise returns return
+    code and content of stdout and content of stderr.
+    """
+    with tracing.span('subprocess', _operation(cmd),
+                      workdir=workdir) as record:
+        proc, err, threads = _spawn(cmd, workdir, input, env, limit, log)
+        if stream:
+            out = Tail(limit)
+            for line in iter(proc.stdout.readline, ''):
+                out.write(line)
+                stream(line)
+            size, out = out.size, out.getvalue()
+        else:
+            out = proc.stdout.read()
+            size = len(out)
+        rc = _finish(proc, threads)
+        record.update(
+            exit_code=rc, stdout_bytes=size, stderr_bytes=err.size
+        )
+        err = err.getvalue()
+
+    if rc and can_fail:
+        raise ExecutionError(
+            'Failed to execute command: %s' % _format_cmd(cmd),
+            stdout=out, stderr=err
+        )
+    return rc, out, err
+
+
+def iter_lines(cmd, workdir=None, input=None, env=None, log=True,
+               limit=OUTPUT_LIMIT):
+    """Runs command given as list of arguments without shell and yields
+    lines of its stdout as they come. ExecutionError is raised after last
+    line in case the command returned non-zero return code.
+    """
+    start = time.time()
+    proc, err, threads = _spawn(cmd, workdir, input, env, limit, log)
+    out = Tail(limit)
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            out.write(line)
+            yield line
+    finally:
+        rc = _finish(proc, threads)
+        tracing.add(
+            'subprocess', _operation(cmd), start, workdir=workdir,
+            exit_code=rc, stdout_bytes=out.size, stderr_bytes=err.size
+        )
+    if rc:
+        raise ExecutionError(
+            'Failed to execute command: %s' % _format_cmd(cmd),
+            stdout=out.getvalue(), stderr=err.getvalue()
+        )
 
 
 # taken from Kanzo (https://github.com/paramite/kanzo)
-def retry(count=1, delay=0, retry_on=Exception):
+def retry(count=1, delay=0, retry_on=Exception, backoff=1, jitter=0,
+          max_delay=None):
     """Decorator which tries to run specified callable if the previous
     run ended by given exception. Retry count and delays can be also
-    specified.
+    specified. Delay is multiplied by 'backoff' after each try (up to
+    'max_delay') and prolonged by random part of up to 'jitter' times
+    the delay, so that failing callers do not retry all at once.
     """
-    if count < 0 or delay < 0:
+    if count < 0 or delay < 0 or jitter < 0:
         raise ValueError('Count and delay has to be positive number.')
+    if backoff < 1:
+        raise ValueError('Backoff has to be at least 1.')
 
     def decorator(func):
         def wrapper(*args, **kwargs):
@@ -71,13 +207,45 @@ def retry(count=1, delay=0, retry_on=Exception):
                     if tried >= count:
                         raise
                     if delay:
-                        time.sleep(delay)
+                        wait = delay * backoff ** tried
+                        if max_delay is not None:
+                            wait = min(wait, max_delay)
+                        time.sleep(wait + random.uniform(0, wait * jitter))
                     tried += 1
         wrapper.func_name = func.func_name
         return wrapper
     return decorator
 
 
+def parallel(func, items, jobs=1):
+    """Runs callable func for each of given items using pool of 'jobs'
+    threads. Returns list of (item, result, exception) tuples in the order
+    of given items, so that failure of one item does not affect the others.
+    """
+    from multiprocessing.pool import ThreadPool
+    stream = getattr(OUTPUT, 'stream', None)
+
+    def call(item):
+        OUTPUT.stream = stream
+        try:
+            return item, func(item), None
+        except Exception:
+            return item, None, sys.exc_info()[1]
+
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [call(item) for item in items]
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        # one item per task, so that threads always work on consecutive
+        # items and callers waiting for their turn do not hold back
+        # items queued behind them
+        return pool.map(call, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def shout(msg, verbose=False, nl=True, level='info'):
     """Logs given msg and in case verbose is set to True the message is
     also printed to stdout.
@@ -89,33 +257,138 @@ def shout(msg, verbose=False, nl=True, level='info'):
                 '[{0}] '.format(level) if level else '',
                 msg
             ),
-            nl=nl
+            nl=nl,
+            file=getattr(OUTPUT, 'stream', None)
         )
 
 
 def get_current_branch(repo):
     """Returns current branch of given repo."""
-    rc, stdout, stderr = execute(
-        'cd {repo} && '
-        'git branch'.format(**locals())
-    )
-    for line in stdout.split('\n'):
-        if line.strip().startswith('*'):
-            return line.strip(' *\t\n')
-    raise ExecutionError('Impossible to find current branch via '
-                         'command "git branch"',
-                         stdout=stdout, stderr=stderr)
+    from . import git
+    return git.get_session(repo).current_branch()
+
+
+class PuppetFileError(ValueError):
+    """Raised when Puppetfile contains syntax which can not be parsed."""
+
+
+RE_PUPPETFILE_TOKEN = re.compile(r"""
+    (?:[ \t\r]|\\\n)*
+  (?:
+    (?P<comment>\#[^\n]*)
+  | (?P<newline>\n)
+  | (?P<eof>\Z)
+  | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<symbol>:[A-Za-z_]\w*)
+  | (?P<label>[A-Za-z_]\w*:(?!:))
+  | (?P<arrow>=>)
+  | (?P<comma>,)
+  | (?P<word>[A-Za-z_][\w\.\-/]*)
+  | (?P<other>.)
+  )
+""", re.VERBOSE | re.DOTALL)
+RE_ESCAPE = re.compile(r'\\(.)')
+
+
+def _unquote(token):
+    token = token[1:-1]
+    return RE_ESCAPE.sub(r'\1', token) if '\\' in token else token
+
+
+def _quote(value):
+    return "'{0}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+class Module(object):
+    """Puppetfile module record. Options (git, commit, ref, ...) are
+    accessible via mapping interface and changes to them are tracked,
+    so that only changed values are rewritten when Puppetfile is saved.
+    """
+    __slots__ = ('name', 'version', '_keys', '_values', '_spans',
+                 '_span', '_changed')
+
+    def __init__(self, name, options=None, version=None):
+        self.name = name
+        self.version = version
+        self._keys = []
+        self._values = {}
+        # key -> (end of preceding token, start of key, end of value)
+        self._spans = {}
+        # (start, end) of whole statement in source
+        self._span = None
+        self._changed = set()
+        for key in sorted(options or {}):
+            self[key] = options[key]
+
+    def __repr__(self):
+        return 'Module({0!r}, {1!r})'.format(self.name, dict(self.items()))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._values:
+            self._keys.append(key)
+        elif self._values[key] == value:
+            return
+        self._values[key] = value
+        self._changed.add(key)
+
+    def __delitem__(self, key):
+        del self._values[key]
+        self._keys.remove(key)
+        self._changed.add(key)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return [self._values[key] for key in self._keys]
+
+    def items(self):
+        return [(key, self._values[key]) for key in self._keys]
+
+    def copy(self):
+        """Returns independent copy of the record."""
+        module = Module(self.name, version=self.version)
+        module._keys = list(self._keys)
+        module._values = dict(self._values)
+        module._spans = dict(self._spans)
+        module._span = self._span
+        module._changed = set(self._changed)
+        return module
+
+
+_parse_cache = collections.OrderedDict()
+_parse_lock = threading.Lock()
 
 
 class PuppetFile(object):
-    """Puppetfile parser"""
-    _content = {}
+    """Puppetfile parser. Layout of the file (comments, ordering, other
+    statements) is preserved and only changed entries are rewritten
+    on save.
+    """
 
     def __init__(self, repo):
         self._fpath = os.path.join(
             os.path.abspath(repo),
             'Puppetfile'
         )
+        self._content = collections.OrderedDict()
+        self._removed = []
+        self._source = ''
 
     def __len__(self):
         return len(self._content)
@@ -124,63 +397,421 @@ class PuppetFile(object):
         return self._content[key]
 
     def __setitem__(self, key, value):
+        if not isinstance(value, Module):
+            value = Module(key, value)
+        if key in self._content:
+            self._removed.append(self._content[key])
         self._content[key] = value
 
+    def __delitem__(self, key):
+        self._removed.append(self._content.pop(key))
+
     def __contains__(self, item):
         return item in self._content
 
     def __iter__(self):
-        return iter(self._content.keys())
+        return iter(list(self._content.keys()))
 
     def keys(self):
-        return self._content.keys()
+        return list(self._content.keys())
 
     def values(self):
-        return self._content.values()
+        return list(self._content.values())
 
     def items(self):
-        return self._content.items()
+        return list(self._content.items())
 
     def load(self, source=None):
         """Loads modules information from Puppetfile 'source'."""
-        # TO-DO: Implement smarter parser
-        re_head = re.compile(
-            r'^mod\s+["\'](?P<name>[\w\-]+)["\']\s*,\s*\n$'
-        )
-        re_info = re.compile(
-            r'\s+\:(?P<key>\w+)'
-                r'\s*=>\s*'
-            r'["\'](?P<value>[\w\-\/\.\:]+)["\']\s*,?\s*\n$'
-        )
         fpath = source or self._fpath
         with open(fpath) as puppetfile:
-            mod = None
-            for line in puppetfile:
-                match = re_head.match(line)
-                if match:
-                    mod = match.group('name')
+            self.loads(puppetfile.read())
+
+    def loads(self, text):
+        """Loads modules information from Puppetfile content 'text'.
+        Parsed content of last PARSE_CACHE_SIZE Puppetfiles is cached,
+        so that long running processes do not parse the same content again.
+        """
+        with _parse_lock:
+            modules = _parse_cache.pop(text, None)
+            if modules is None:
+                modules = self._parse(text)
+            _parse_cache[text] = modules
+            while len(_parse_cache) > PARSE_CACHE_SIZE:
+                _parse_cache.popitem(last=False)
+        self._content = collections.OrderedDict(
+            (module.name, module.copy()) for module in modules
+        )
+        self._removed = []
+        self._source = text
+
+    def _tokenize(self, text):
+        """Returns list of (kind, value, start, end) tokens of 'text'."""
+        tokens = [
+            (match.lastgroup, match.group(match.lastgroup),
+             match.start(match.lastgroup), match.end())
+            for match in RE_PUPPETFILE_TOKEN.finditer(text)
+        ]
+        for token in tokens:
+            if token[0] == 'other':
+                raise PuppetFileError(
+                    'Unexpected character {0!r} on line {1}'.format(
+                        token[1], text.count('\n', 0, token[2]) + 1
+                    )
+                )
+        return tokens
+
+    def _parse(self, text):
+        """Returns list of Module records parsed from given 'text'."""
+        tokens = self._tokenize(text)
+        position = [0]
+
+        def error(token, expected):
+            raise PuppetFileError(
+                'Expected {0} on line {1}, got {2!r}'.format(
+                    expected, text.count('\n', 0, token[2]) + 1, token[1]
+                )
+            )
+
+        def take(*kinds, **kwargs):
+            # skips comments and, after comma or arrow, also newlines
+            skip = ('comment', 'newline') if kwargs.get('wrap') else (
+                'comment',
+            )
+            while tokens[position[0]][0] in skip:
+                position[0] += 1
+            token = tokens[position[0]]
+            if kinds and token[0] not in kinds:
+                error(token, ' or '.join(kinds))
+            position[0] += 1
+            return token
+
+        def peek():
+            index = position[0]
+            while tokens[index][0] == 'comment':
+                index += 1
+            return tokens[index]
+
+        modules = []
+        while True:
+            token = take()
+            kind = token[0]
+            if kind == 'eof':
+                break
+            if kind == 'newline':
+                continue
+            if kind != 'word':
+                error(token, 'statement')
+            if token[1] != 'mod':
+                # other statements (forge, moduledir, ...) are kept as is
+                while peek()[0] not in ('newline', 'eof'):
+                    skipped = take()
+                    if skipped[0] == 'comma':
+                        take(wrap=True)
+                continue
+
+            name = take('string', wrap=True)
+            module = Module(_unquote(name[1]))
+            end = name[3]
+            first = True
+            while peek()[0] == 'comma':
+                comma = take('comma')
+                key = take('string', 'symbol', 'label', wrap=True)
+                if key[0] == 'string':
+                    if not first:
+                        error(key, 'option')
+                    module.version = _unquote(key[1])
+                    end = key[3]
+                    first = False
                     continue
-                match = re_info.match(line)
-                if match:
-                    mod_dict = self._content.setdefault(mod, {})
-                    key = match.group('key')
-                    value = match.group('value')
-                    mod_dict[key] = value
+                if key[0] == 'symbol':
+                    take('arrow', wrap=True)
+                    option = key[1][1:]
+                else:
+                    option = key[1][:-1]
+                value = take('string', 'symbol', 'word', wrap=True)
+                module._keys.append(option)
+                if value[0] == 'string':
+                    module._values[option] = _unquote(value[1])
+                elif value[0] == 'symbol':
+                    module._values[option] = value[1][1:]
+                else:
+                    module._values[option] = value[1]
+                module._spans[option] = (end, key[2], value[3])
+                end = value[3]
+                first = False
+            module._span = (token[2], end)
+            if peek()[0] not in ('newline', 'eof'):
+                error(peek(), 'end of line')
+            modules.append(module)
+        return modules
+
+    def dumps(self):
+        """Returns content of Puppetfile with all changes applied."""
+        text = self._source
+        edits = []
+        for module in self._removed:
+            if not module._span:
+                continue
+            start = text.rfind('\n', 0, module._span[0]) + 1
+            end = text.find('\n', module._span[1])
+            end = len(text) if end < 0 else end + 1
+            if text[end:end + 1] == '\n':
+                end += 1
+            edits.append((start, end, ''))
+        appended = []
+        for name, module in self._content.items():
+            if not module._span:
+                appended.append(module)
+                continue
+            for key in sorted(module._changed):
+                span = module._spans.get(key)
+                if key not in module:
+                    if span:
+                        edits.append((span[0], span[2], ''))
+                elif span:
+                    edits.append(
+                        (self._value_start(span), span[2],
+                         _quote(module[key]))
+                    )
+                else:
+                    edits.append((
+                        module._span[1], module._span[1],
+                        self._option_format(module).format(
+                            key, _quote(module[key])
+                        )
+                    ))
+        for start, end, replacement in sorted(edits, reverse=True):
+            text = text[:start] + replacement + text[end:]
+
+        for module in appended:
+            if text and not text.endswith('\n'):
+                text += '\n'
+            if text and not text.endswith('\n\n'):
+                text += '\n'
+            text += "mod {0}".format(_quote(module.name))
+            for key, value in module.items():
+                text += ",\n  :{0} => {1}".format(key, _quote(value))
+            text += '\n'
+        return text
+
+    def _option_format(self, module):
+        """Returns format of new option of parsed 'module' following
+        the layout of its existing options.
+        """
+        start, end = module._span
+        if not module._spans:
+            return ",\n  :{0} => {1}"
+        key_start = max(span[1] for span in module._spans.values())
+        line_start = self._source.rfind('\n', start, key_start)
+        separator = (
+            ', ' if line_start < 0 else
+            ',\n' + self._source[line_start + 1:key_start]
+        )
+        if self._source[key_start] == ':':
+            return separator + ':{0} => {1}'
+        return separator + '{0}: {1}'
+
+    def _value_start(self, span):
+        """Returns start of value token of option given by its span."""
+        tokens = self._tokenize(self._source[span[1]:span[2]])
+        return span[1] + tokens[-2][2]
 
     def save(self, destination=None):
         """Saves modules information to Puppetfile 'destination'."""
-        fmt_head = "mod '{name}',\n"
-        fmt_info = "  :{key} => '{value}'"
-
+        text = self.dumps()
         fpath = destination or self._fpath
+        if fpath == self._fpath and text == self._source and \
+                os.path.exists(fpath):
+            return
         with open(fpath, 'w') as puppetfile:
-            for module in sorted(self._content.keys()):
-                puppetfile.write(fmt_head.format(name=module))
-                keys = self._content[module].keys()
-                for key in sorted(self._content[module].keys()):
-                    value = self._content[module][key]
-                    puppetfile.write(
-                        fmt_info.format(key=key, value=value)
-                    )
-                    keys.remove(key)
-                    puppetfile.write(',\n' if keys else '\n\n')
+            puppetfile.write(text)
+        if fpath != self._fpath:
+            return
+        # refresh positions of entries, so that further changes
+        # are applied to the new content
+        for module in self._parse(text):
+            if module.name in self._content:
+                current = self._content[module.name]
+                current._spans = module._spans
+                current._span = module._span
+                current._changed = set()
+        self._removed = []
+        self._source = text
+
+
+class LockFile(object):
+    """Puppetfile.lock stored next to Puppetfile. For each module it records
+    upstream URL and commit or ref pinned in Puppetfile together with
+    resolved commit hash and tree hash of the module content. Entry is valid
+    only as long as URL and pin in Puppetfile stay the same.
+    """
+
+    def __init__(self, repo):
+        self._fpath = os.path.join(repo, 'Puppetfile.lock')
+        self._content = {}
+        self._source = None
+
+    def __contains__(self, module):
+        return module in self._content
+
+    def __getitem__(self, module):
+        return self._content[module]
+
+    def __iter__(self):
+        return iter(sorted(self._content))
+
+    def load(self):
+        """Loads lock file if it exists."""
+        self._content = {}
+        self._source = None
+        if not os.path.exists(self._fpath):
+            return
+        with open(self._fpath) as lockfile:
+            self.loads(lockfile.read())
+
+    def loads(self, text):
+        """Loads lock file content 'text'."""
+        self._content = {}
+        self._source = text
+        try:
+            content = json.loads(text)
+        except ValueError as ex:
+            raise PuppetFileError(
+                'Invalid lock file {0}: {1}'.format(self._fpath, ex)
+            )
+        for module, entry in content.get('modules', {}).items():
+            self._content[module] = dict(
+                (str(key), str(value)) for key, value in entry.items()
+            )
+
+    def get(self, module, info):
+        """Returns lock entry of given module if it matches Puppetfile
+        module 'info', otherwise returns None.
+        """
+        entry = self._content.get(module)
+        if entry is None:
+            return None
+        pin = info['commit'] if 'commit' in info else info['ref']
+        if entry['git'] != info['git'] or entry['ref'] != pin:
+            return None
+        return entry
+
+    def resolve(self, module, info):
+        """Returns copy of Puppetfile module 'info' pinned to the locked
+        commit hash if lock entry is valid.
+        """
+        resolved = dict(info)
+        entry = self.get(module, info)
+        if entry:
+            resolved.pop('ref', None)
+            resolved['commit'] = entry['commit']
+        return resolved
+
+    def set(self, module, info, commit, tree):
+        """Records resolved 'commit' and 'tree' hash of given module.
+        Returns True if the entry has changed.
+        """
+        entry = {
+            'git': info['git'],
+            'ref': info['commit'] if 'commit' in info else info['ref'],
+            'commit': commit,
+            'tree': tree,
+        }
+        changed = self._content.get(module) != entry
+        self._content[module] = entry
+        return changed
+
+    def prune(self, modules):
+        """Removes entries of modules which are not in given 'modules'."""
+        for module in list(self._content):
+            if module not in modules:
+                del self._content[module]
+
+    def dumps(self):
+        return json.dumps(
+            {'modules': self._content}, indent=2, sort_keys=True,
+            separators=(',', ': ')
+        ) + '\n'
+
+    def save(self):
+        """Writes lock file if its content has changed."""
+        text = self.dumps()
+        if text == self._source:
+            return
+        with open(self._fpath, 'w') as lockfile:
+            lockfile.write(text)
+        self._source = text
+
+
+RE_SPEC_SECTION = re.compile(
+    r'^%(package|description|prep|build|install|check|clean|files|'
+    r'changelog|pre|post|preun|postun|pretrans|posttrans|trigger\w*|'
+    r'verifyscript)(?=\s|$)'
+)
+RE_SPEC_PATCH = re.compile(r'^Patch(\d*):\s*(.*?)\s*$')
+RE_SPEC_APPLY = re.compile(r'^%patch(\d*)(.*?)\s*$')
+
+SpecPatch = collections.namedtuple('SpecPatch', ['number', 'source', 'line'])
+SpecApply = collections.namedtuple('SpecApply', ['number', 'options', 'line'])
+
+
+class SpecFile(object):
+    """SPEC file parsed in a single streaming pass. Attribute 'patches'
+    contains PatchN declarations, 'applies' contains %patchN applications,
+    'sections' maps section headers (without '%', '' for preamble) to
+    section content and 'changelog' contains everything after the
+    %changelog header.
+    """
+
+    def __init__(self, fpath):
+        self._fpath = fpath
+        self.patches = []
+        self.applies = []
+        self.sections = collections.OrderedDict()
+        self.changelog = u''
+
+    @property
+    def patches_list(self):
+        """PatchN declaration lines as they are in SPEC file."""
+        return u''.join(patch.line for patch in self.patches)
+
+    @property
+    def patches_apply(self):
+        """%patchN application lines as they are in SPEC file."""
+        return u''.join(apply.line for apply in self.applies)
+
+    def load(self):
+        """Parses SPEC file."""
+        sections = collections.OrderedDict([(u'', [])])
+        current = sections[u'']
+        changelog = None
+        with codecs.open(self._fpath, 'r', 'utf-8') as spec:
+            for line in spec:
+                if changelog is not None:
+                    changelog.append(line)
+                    continue
+                if RE_SPEC_SECTION.match(line):
+                    if line.startswith('%changelog'):
+                        # changelog is the last section, the rest of file
+                        # is just copied
+                        changelog = [line[len('%changelog'):]]
+                        continue
+                    current = sections.setdefault(line[1:].strip(), [])
+                    continue
+                current.append(line)
+                match = RE_SPEC_PATCH.match(line)
+                if match:
+                    self.patches.append(SpecPatch(
+                        int(match.group(1) or 0), match.group(2), line
+                    ))
+                    continue
+                match = RE_SPEC_APPLY.match(line)
+                if match:
+                    self.applies.append(SpecApply(
+                        int(match.group(1) or 0), match.group(2).strip(), line
+                    ))
+        self.sections = collections.OrderedDict(
+            (name, u''.join(lines)) for name, lines in sections.items()
+        )
+        self.changelog = u''.join(changelog or [])
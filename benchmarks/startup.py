@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Startup benchmark of bade CLI.
+
+Runs "bade --help" and "bade clean" (in a throwaway git repo with empty
+Puppetfile) several times in fresh interpreters and reports median wall
+time of each scenario. Benchmark fails in case median time exceeds
+--max seconds or in case scenario imports modules it does not need
+(other subcommands, jinja2).
+
+Usage: python benchmarks/startup.py [--runs N] [--max SECONDS] [--json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs bade in-process and reports which of the watched modules got imported
+RUNNER = '''
+import json, sys
+from bade import bade
+try:
+    bade.bade(sys.argv[1:], prog_name='bade')
+except SystemExit:
+    pass
+imported = sorted(
+    name for name, module in sys.modules.items()
+    if module is not None and (name == 'jinja2' or
+                               name.startswith('bade.commands.'))
+)
+sys.stderr.write(json.dumps(imported) + '\\n')
+'''
+
+SCENARIOS = [
+    ('help', ['--help'], []),
+    ('clean', ['--log', '{log}', '--no-daemon', 'clean', '{repo}'],
+     ['bade.commands.clean', 'bade.commands.init']),
+]
+
+
+def make_repo(path):
+    """Creates git repo with empty Puppetfile."""
+    env = dict(os.environ,
+               GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost',
+               GIT_COMMITTER_NAME='bench',
+               GIT_COMMITTER_EMAIL='bench@localhost')
+    subprocess.check_call(['git', 'init', '-q', path])
+    open(os.path.join(path, 'Puppetfile'), 'w').close()
+    subprocess.check_call(['git', 'add', 'Puppetfile'], cwd=path)
+    subprocess.check_call(['git', 'commit', '-q', '-m', 'init'],
+                          cwd=path, env=env)
+
+
+def run_scenario(args, runs):
+    """Returns tuple (durations, imported modules) of given scenario."""
+    durations = []
+    imported = []
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    for _ in range(runs):
+        start = time.time()
+        proc = subprocess.Popen(
+            [sys.executable, '-c', RUNNER] + args, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stdout, stderr = proc.communicate()
+        durations.append(time.time() - start)
+        imported = json.loads(stderr.strip().splitlines()[-1])
+    return durations, imported
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Number of runs of each scenario.')
+    parser.add_argument('--max', type=float, default=None,
+                        help='Maximal allowed median time in seconds.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print results as JSON.')
+    options = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='bade-bench-')
+    try:
+        repo = os.path.join(tmpdir, 'repo')
+        make_repo(repo)
+        log = os.path.join(tmpdir, 'bade.log')
+        results = []
+        for name, args, allowed in SCENARIOS:
+            args = [arg.format(repo=repo, log=log) for arg in args]
+            durations, imported = run_scenario(args, options.runs)
+            results.append({
+                'scenario': name,
+                'runs': options.runs,
+                'median': median(durations),
+                'min': min(durations),
+                'max': max(durations),
+                'unexpected_imports': [
+                    module for module in imported if module not in allowed
+                ],
+            })
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    failed = False
+    if options.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    for result in results:
+        if not options.json:
+            print('{scenario:<10}median {median:.3f}s  min {min:.3f}s  '
+                  'max {max:.3f}s'.format(**result))
+        if result['unexpected_imports']:
+            failed = True
+            sys.stderr.write('{0}: unexpected imports: {1}\n'.format(
+                result['scenario'], ', '.join(result['unexpected_imports'])
+            ))
+        if options.max is not None and result['median'] > options.max:
+            failed = True
+            sys.stderr.write('{0}: median {1:.3f}s exceeds {2:.3f}s\n'.format(
+                result['scenario'], result['median'], options.max
+            ))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
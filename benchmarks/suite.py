@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""End to end benchmark suite of bade commands.
+
+For each requested size N the suite generates N local bare upstream repos
+(with --depth commits and --files files each), packaging repo with matching
+Puppetfile and runs "init", "update", "add", "spec" and "clean" against
+them. Each command is run with --trace, so besides wall time the results
+contain time spent in module steps (setup, fetch, checkout, import, ...)
+and in git subprocesses. Upstream repos are generated with fixed dates,
+so commit hashes are the same on each run.
+
+Results are written as JSON to --output. In case --baseline results are
+given, commands which got slower by more than --threshold are reported
+and the suite exits with status 1.
+
+Usage: python benchmarks/suite.py [--sizes 10,100,1000] [--depth D]
+           [--files F] [--jobs J] [--output FILE] [--baseline FILE]
+           [--threshold RATIO] [--keep]
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IDENTITY = {
+    'GIT_AUTHOR_NAME': 'bench',
+    'GIT_AUTHOR_EMAIL': 'bench@localhost',
+    'GIT_COMMITTER_NAME': 'bench',
+    'GIT_COMMITTER_EMAIL': 'bench@localhost',
+}
+OLD_SPEC = '''Name: openstack-puppet-modules
+Patch0001: 0001-bench.patch
+
+%prep
+%setup
+%patch0001 -p1
+
+%changelog
+* Mon Jan 01 2024 bench <bench@localhost> - 0.1-1
+- Initial package
+'''
+
+
+def git(args, cwd=None, input=None):
+    """Runs git command and returns its stdout."""
+    env = dict(os.environ, **IDENTITY)
+    proc = subprocess.Popen(
+        ['git'] + args, cwd=cwd, env=env, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    stdout, stderr = proc.communicate(input)
+    if proc.returncode:
+        raise RuntimeError('git {0} failed: {1}'.format(
+            ' '.join(args), stderr.decode('utf-8', 'replace')
+        ))
+    return stdout.decode('utf-8').strip()
+
+
+def fast_import_stream(name, depth, files):
+    """Returns fast-import stream of upstream repo of module 'name' with
+    'depth' commits. First commit creates 'files' manifests, each following
+    commit changes one of them.
+    """
+    def data(content):
+        content = content.encode('utf-8')
+        return b'data ' + str(len(content)).encode('ascii') + b'\n' + \
+            content + b'\n'
+
+    stream = []
+    for number in range(depth):
+        stream.append(b'commit refs/heads/master\n')
+        stream.append(b'mark :' + str(number + 1).encode('ascii') + b'\n')
+        stream.append(
+            b'committer bench <bench@localhost> ' +
+            str(1500000000 + number * 60).encode('ascii') + b' +0000\n'
+        )
+        stream.append(data('Commit {0} of {1}'.format(number, name)))
+        if number:
+            stream.append(b'from :' + str(number).encode('ascii') + b'\n')
+            changed = [number % files]
+        else:
+            changed = range(files)
+            stream.append(b'M 100644 inline metadata.json\n')
+            stream.append(data(json.dumps({
+                'name': 'bench-{0}'.format(name),
+                'version': '1.0.0',
+                'dependencies': [],
+            })))
+        for index in changed:
+            stream.append(
+                'M 100644 inline manifests/file{0}.pp\n'.format(index)
+                .encode('ascii')
+            )
+            stream.append(data(
+                'class {0}::file{1} {{\n  # revision {2}\n}}\n'.format(
+                    name, index, number
+                ) * 8
+            ))
+    return b''.join(stream)
+
+
+def make_upstream(path, name, depth, files):
+    """Creates bare upstream repo and returns hashes of its commits."""
+    git(['init', '-q', '--bare', path])
+    git(['fast-import', '--quiet'], cwd=path,
+        input=fast_import_stream(name, depth, files))
+    return git(['rev-list', '--reverse', 'master'], cwd=path).split()
+
+
+def make_fixture(workdir, size, depth, files):
+    """Generates upstream repos and packaging repo with Puppetfile pinning
+    modules to previous to last commit. Returns tuple (repo, manifest path
+    with updates to last commits, upstream of module to add).
+    """
+    upstreams = os.path.join(workdir, 'upstreams')
+    os.makedirs(upstreams)
+    puppetfile = []
+    manifest = []
+    for index in range(size + 1):
+        name = 'module{0:04d}'.format(index)
+        path = os.path.join(upstreams, 'puppet-{0}.git'.format(name))
+        commits = make_upstream(path, name, max(depth, 2), files)
+        if index == size:
+            # module used by "add" benchmark
+            added = (path, commits[-1])
+            break
+        puppetfile.append(
+            "mod '{0}',\n  :commit => '{1}',\n  :git => '{2}'\n".format(
+                name, commits[-2], path
+            )
+        )
+        manifest.append('{0} {1}\n'.format(name, commits[-1]))
+
+    repo = os.path.join(workdir, 'repo')
+    git(['init', '-q', repo])
+    git(['config', 'user.name', IDENTITY['GIT_AUTHOR_NAME']], cwd=repo)
+    git(['config', 'user.email', IDENTITY['GIT_AUTHOR_EMAIL']], cwd=repo)
+    with open(os.path.join(repo, 'Puppetfile'), 'w') as fobj:
+        fobj.write('\n'.join(puppetfile))
+    git(['add', 'Puppetfile'], cwd=repo)
+    git(['commit', '-q', '-m', 'Puppetfile'], cwd=repo)
+
+    manifest_path = os.path.join(workdir, 'manifest')
+    with open(manifest_path, 'w') as fobj:
+        fobj.write(''.join(manifest))
+    with open(os.path.join(workdir, 'old.spec'), 'w') as fobj:
+        fobj.write(OLD_SPEC)
+    return repo, manifest_path, added
+
+
+def summarize(trace_path):
+    """Returns tuple (phases, subprocesses) aggregated from trace file."""
+    phases = collections.defaultdict(float)
+    operations = collections.defaultdict(lambda: {'count': 0, 'total': 0.0})
+    if not os.path.exists(trace_path):
+        return {}, {}
+    with open(trace_path) as trace:
+        for line in trace:
+            record = json.loads(line)
+            if record['kind'] == 'step':
+                phases[record['name']] += record['duration']
+            elif record['kind'] == 'subprocess':
+                stats = operations[record['name']]
+                stats['count'] += 1
+                stats['total'] += record['duration']
+    return dict(phases), dict(operations)
+
+
+def run_command(workdir, repo, name, args):
+    """Runs bade command with tracing and returns its result record."""
+    trace = os.path.join(workdir, 'trace-{0}.json'.format(name))
+    env = dict(os.environ, HOME=os.path.join(workdir, 'home'),
+               PYTHONPATH=ROOT, **IDENTITY)
+    cmd = [
+        sys.executable, '-m', 'bade.bade',
+        '--log', os.path.join(workdir, 'bade.log'),
+        '--no-daemon', '--trace', trace,
+    ] + args
+    start = time.time()
+    proc = subprocess.Popen(cmd, cwd=repo, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0].decode('utf-8', 'replace')
+    wall = time.time() - start
+    phases, operations = summarize(trace)
+    errors = [line for line in output.splitlines()
+              if line.startswith('[error]')]
+    return {
+        'command': name,
+        'wall': wall,
+        'exit_code': proc.returncode,
+        'errors': errors,
+        'phases': phases,
+        'subprocesses': operations,
+    }
+
+
+def run_size(size, options):
+    """Runs all benchmarked commands for fixture with 'size' modules."""
+    workdir = tempfile.mkdtemp(prefix='bade-suite-{0}-'.format(size))
+    try:
+        start = time.time()
+        repo, manifest, added = make_fixture(
+            workdir, size, options.depth, options.files
+        )
+        setup = time.time() - start
+        jobs = ['--jobs', str(options.jobs)]
+        steps = [
+            ('init', ['init', '--commit'] + jobs),
+            ('reinit', ['init']),
+            ('update', ['update', '--manifest', manifest, '--commit'] + jobs),
+            ('add', ['add', '--upstream', added[0], '--hash', added[1],
+                     '--commit']),
+            ('spec', ['spec', '--version', '1.0', '--release', '1',
+                      '--old', os.path.join(workdir, 'old.spec'),
+                      '--output', os.path.join(workdir, 'out.spec')]),
+            ('clean', ['clean']),
+        ]
+        results = []
+        for name, args in steps:
+            result = run_command(workdir, repo, name, args)
+            result['modules'] = size
+            results.append(result)
+            sys.stderr.write('{0:>6} modules {1:<8}{2:>10.3f}s\n'.format(
+                size, name, result['wall']
+            ))
+        return setup, results
+    finally:
+        if options.keep:
+            sys.stderr.write('Fixture kept in {0}\n'.format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline, threshold):
+    """Returns list of messages about commands which are slower than
+    in 'baseline' by more than 'threshold' ratio.
+    """
+    previous = dict(
+        ((item['modules'], item['command']), item)
+        for item in baseline.get('results', [])
+    )
+    regressions = []
+    for item in results:
+        old = previous.get((item['modules'], item['command']))
+        if not old or not old['wall']:
+            continue
+        ratio = item['wall'] / old['wall']
+        if ratio > threshold:
+            regressions.append(
+                '{0} with {1} modules: {2:.3f}s -> {3:.3f}s ({4:.2f}x)'.format(
+                    item['command'], item['modules'], old['wall'],
+                    item['wall'], ratio
+                )
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='Comma separated numbers of modules.')
+    parser.add_argument('--depth', type=int, default=10,
+                        help='Number of commits in each upstream repo.')
+    parser.add_argument('--files', type=int, default=20,
+                        help='Number of files in each upstream repo.')
+    parser.add_argument('--jobs', type=int, default=8,
+                        help='Value of --jobs option of bade commands.')
+    parser.add_argument('--output', default='bade-benchmark.json',
+                        help='Path to JSON file with results.')
+    parser.add_argument('--baseline', default=None,
+                        help='Path to JSON file with results to compare to.')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Maximal allowed ratio of wall time compared '
+                             'to baseline.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep generated fixtures.')
+    options = parser.parse_args()
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'git': git(['--version']),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'depth': options.depth,
+            'files': options.files,
+            'jobs': options.jobs,
+        },
+        'setup': {},
+        'results': [],
+    }
+    for size in [int(size) for size in options.sizes.split(',')]:
+        setup, results = run_size(size, options)
+        report['setup'][str(size)] = setup
+        report['results'].extend(results)
+
+    with open(options.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+
+    failed = False
+    for item in report['results']:
+        if item['exit_code'] or item['errors']:
+            failed = True
+            sys.stderr.write('{0} with {1} modules failed: {2}\n'.format(
+                item['command'], item['modules'], '; '.join(item['errors'])
+            ))
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = compare(
+                report['results'], json.load(baseline), options.threshold
+            )
+        for message in regressions:
+            failed = True
+            sys.stderr.write('Regression: {0}\n'.format(message))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
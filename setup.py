@@ -8,7 +8,7 @@ setup(
     version='0.1',
     author='Martin Magr',
     author_email='mmagr@redhat.com',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
     include_package_data=True,
     install_requires=[
         'Click',
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+
+# bade logs to a file set up by the CLI, tests keep the log silent
+logging.getLogger('bade').addHandler(logging.NullHandler())
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from bade import git
+from bade import utils
+
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'Tester', 'GIT_AUTHOR_EMAIL': 'tester@example.com',
+    'GIT_COMMITTER_NAME': 'Tester',
+    'GIT_COMMITTER_EMAIL': 'tester@example.com',
+}
+
+
+def run_git(repo, *args, **kwargs):
+    """Runs git command in 'repo' and returns its stripped stdout."""
+    env = dict(GIT_ENV, **kwargs.pop('env', {}))
+    rc, stdout, stderr = utils.run(
+        ['git'] + list(args), workdir=repo, env=env, **kwargs
+    )
+    return stdout.strip()
+
+
+def write_file(repo, name, content):
+    """Writes 'content' to file 'name' in working tree of 'repo'."""
+    path = os.path.join(repo, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fobj:
+        fobj.write(content)
+
+
+def commit_file(repo, name, content):
+    """Commits file 'name' with 'content' to 'repo' and returns commit."""
+    write_file(repo, name, content)
+    run_git(repo, 'add', name)
+    run_git(repo, 'commit', '-q', '-m', content)
+    return run_git(repo, 'rev-parse', 'HEAD')
+
+
+class RepoTestCase(unittest.TestCase):
+    """Test case working in temporary directory, which is removed
+    together with cached git sessions after each test.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        git.close_sessions()
+        shutil.rmtree(self.tmp)
+
+    def make_repo(self, name='repo', bare=False):
+        """Creates empty repo in temporary directory, returns its path."""
+        path = os.path.join(self.tmp, name)
+        utils.run(['git', 'init', '-q'] + (['--bare'] if bare else []) +
+                  [path])
+        for key in ('name', 'email'):
+            run_git(path, 'config', 'user.{0}'.format(key),
+                    GIT_ENV['GIT_AUTHOR_{0}'.format(key.upper())])
+        return path
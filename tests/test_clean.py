@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from bade.commands import clean
+from tests import helpers
+
+
+class DeleteRefsTest(helpers.RepoTestCase):
+
+    def setUp(self):
+        super(DeleteRefsTest, self).setUp()
+        self.repo = self.make_repo()
+        self.commit = helpers.commit_file(
+            self.repo, 'Puppetfile', "mod 'nova'\n"
+        )
+        self.refs = {}
+        for module in ('apache', 'mysql', 'nova'):
+            ref = 'refs/bade/master/{0}'.format(module)
+            helpers.run_git(self.repo, 'update-ref', ref, self.commit)
+            self.refs[ref] = self.commit
+
+    def remaining(self):
+        return helpers.run_git(
+            self.repo, 'for-each-ref', '--format=%(refname)', 'refs/bade/'
+        ).splitlines()
+
+    def test_delete_refs(self):
+        self.assertEqual(clean.delete_refs(self.repo, self.refs), [])
+        self.assertEqual(self.remaining(), [])
+
+    def test_no_refs(self):
+        self.assertEqual(clean.delete_refs(self.repo, {}), [])
+
+    def test_failed_ref_is_reported(self):
+        # ref which has moved fails the transaction, others are deleted
+        # one by one
+        moved = helpers.commit_file(
+            self.repo, 'Puppetfile', "mod 'mysql'\n"
+        )
+        helpers.run_git(
+            self.repo, 'update-ref', 'refs/bade/master/mysql', moved
+        )
+        self.assertEqual(
+            clean.delete_refs(self.repo, self.refs),
+            ['refs/bade/master/mysql']
+        )
+        self.assertEqual(self.remaining(), ['refs/bade/master/mysql'])
+
+
+if __name__ == '__main__':
+    unittest.main()
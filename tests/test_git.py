@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+from bade import git
+from bade import utils
+from tests import helpers
+
+
+class RemoveConfigSectionsTest(helpers.RepoTestCase):
+
+    def setUp(self):
+        super(RemoveConfigSectionsTest, self).setUp()
+        self.repo = self.make_repo()
+        for key, value in (('remote.master-nova.url', 'nova'),
+                           ('remote.master-nova.fetch', 'refs'),
+                           ('branch.master-nova.remote', 'master-nova'),
+                           ('remote.origin.url', 'origin')):
+            helpers.run_git(self.repo, 'config', key, value)
+        self.config = os.path.join(self.repo, '.git', 'config')
+
+    def test_remove_sections(self):
+        removed = git.remove_config_sections(
+            self.repo, [('remote', 'master-nova'), ('branch', 'master-nova'),
+                        ('remote', 'missing')]
+        )
+        self.assertEqual(
+            removed,
+            set([('remote', 'master-nova'), ('branch', 'master-nova')])
+        )
+        self.assertEqual(
+            helpers.run_git(self.repo, 'config', '--get-regexp', 'remote'),
+            'remote.origin.url origin'
+        )
+        self.assertFalse(os.path.exists(self.config + '.lock'))
+
+    def test_section_names_are_case_insensitive(self):
+        removed = git.remove_config_sections(
+            self.repo, [('Remote', 'master-nova')]
+        )
+        self.assertEqual(removed, set([('remote', 'master-nova')]))
+
+    def test_cached_config_is_invalidated(self):
+        session = git.get_session(self.repo)
+        self.assertEqual(session.config('remote.master-nova.url'), 'nova')
+        git.remove_config_sections(self.repo, [('remote', 'master-nova')])
+        self.assertIsNone(session.config('remote.master-nova.url'))
+
+    def test_locked_config(self):
+        open(self.config + '.lock', 'w').close()
+        self.assertRaises(
+            utils.ExecutionError, git.remove_config_sections, self.repo,
+            [('remote', 'master-nova')]
+        )
+        self.assertEqual(
+            helpers.run_git(self.repo, 'config', 'remote.master-nova.url'),
+            'nova'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
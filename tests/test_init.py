@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+from bade import utils
+from bade.commands import init
+from tests import helpers
+
+
+class CommitIndexTest(helpers.RepoTestCase):
+
+    def setUp(self):
+        super(CommitIndexTest, self).setUp()
+        source = self.make_repo('source')
+        helpers.commit_file(source, 'init.pp', 'class nova {}\n')
+        self.repo = self.make_repo()
+        self.tip = helpers.commit_file(
+            self.repo, 'Puppetfile', "mod 'nova'\n"
+        )
+        helpers.run_git(
+            self.repo, 'fetch', '-q', source,
+            '+master:{0}'.format(init.module_ref('master', 'nova'))
+        )
+        self.files = {'Puppetfile': "mod 'nova', :commit => 'abc1234'\n"}
+
+    def read(self, name):
+        with open(os.path.join(self.repo, name)) as fobj:
+            return fobj.read()
+
+    def commit(self, prepare=None, worktree=True):
+        with init.temporary_index(self.repo, 'master', self.tip,
+                                  worktree=worktree) as env:
+            init.import_module(self.repo, 'master', 'nova', env=env)
+            if prepare:
+                prepare()
+            return init.commit_index(
+                self.repo, 'master', self.tip, env, self.files, 'update',
+                ['nova'], worktree=worktree
+            )
+
+    def test_commit_updates_worktree(self):
+        new = self.commit()
+        self.assertEqual(helpers.run_git(self.repo, 'rev-parse', 'HEAD'), new)
+        self.assertEqual(self.read('Puppetfile'), self.files['Puppetfile'])
+        self.assertEqual(self.read('nova/init.pp'), 'class nova {}\n')
+        self.assertEqual(
+            helpers.run_git(self.repo, 'status', '--porcelain'), ''
+        )
+
+    def test_no_checkout_leaves_worktree(self):
+        new = self.commit(worktree=False)
+        self.assertEqual(helpers.run_git(self.repo, 'rev-parse', 'HEAD'), new)
+        self.assertEqual(self.read('Puppetfile'), "mod 'nova'\n")
+        self.assertFalse(os.path.exists(os.path.join(self.repo, 'nova')))
+
+    def test_unchanged_tree_is_not_committed(self):
+        self.files = {'Puppetfile': "mod 'nova'\n"}
+        with init.temporary_index(self.repo, 'master', self.tip) as env:
+            self.assertIsNone(init.commit_index(
+                self.repo, 'master', self.tip, env, self.files, 'update', []
+            ))
+
+    def test_changes_staged_meanwhile_are_kept(self):
+        def stage():
+            helpers.write_file(self.repo, 'README', 'readme\n')
+            helpers.run_git(self.repo, 'add', 'README')
+
+        new = self.commit(prepare=stage)
+        self.assertEqual(
+            helpers.run_git(self.repo, 'ls-tree', '--name-only', new),
+            'Puppetfile\nREADME\nnova'
+        )
+        self.assertEqual(
+            helpers.run_git(self.repo, 'status', '--porcelain'), ''
+        )
+
+    def test_moved_branch_leaves_worktree(self):
+        def move():
+            helpers.commit_file(self.repo, 'README', 'readme\n')
+
+        self.assertRaises(utils.ExecutionError, self.commit, prepare=move)
+        self.assertEqual(self.read('Puppetfile'), "mod 'nova'\n")
+        self.assertFalse(os.path.exists(os.path.join(self.repo, 'nova')))
+        self.assertEqual(
+            helpers.run_git(self.repo, 'ls-files'), 'Puppetfile\nREADME'
+        )
+
+    def test_local_changes_are_refused(self):
+        self.commit()
+        self.tip = helpers.run_git(self.repo, 'rev-parse', 'HEAD')
+        helpers.write_file(self.repo, 'nova/init.pp', 'local change\n')
+        helpers.write_file(self.repo, 'nova/new.pp', 'untracked\n')
+        self.files = {'Puppetfile': "mod 'nova', :commit => 'def5678'\n"}
+        try:
+            self.commit()
+        except utils.ExecutionError as ex:
+            self.assertIn('nova/init.pp, nova/new.pp', str(ex))
+        else:
+            self.fail('Local changes were not refused')
+        self.assertEqual(
+            helpers.run_git(self.repo, 'rev-parse', 'HEAD'), self.tip
+        )
+        self.assertEqual(self.read('nova/init.pp'), 'local change\n')
+        self.assertEqual(
+            self.read('Puppetfile'), "mod 'nova', :commit => 'abc1234'\n"
+        )
+
+    def test_changes_outside_modules_are_kept(self):
+        helpers.write_file(self.repo, 'README', 'local change\n')
+        self.commit()
+        self.assertEqual(self.read('README'), 'local change\n')
+
+
+class ReplaceIndexTest(helpers.RepoTestCase):
+
+    def setUp(self):
+        super(ReplaceIndexTest, self).setUp()
+        self.repo = self.make_repo()
+        helpers.commit_file(self.repo, 'Puppetfile', "mod 'nova'\n")
+        self.git_dir = os.path.join(self.repo, '.git')
+        self.index = os.path.join(self.git_dir, 'bade-index-master')
+        helpers.run_git(
+            self.repo, 'read-tree', '--empty',
+            env={'GIT_INDEX_FILE': self.index}
+        )
+
+    def test_replace_index(self):
+        init.replace_index(self.repo, self.index)
+        self.assertFalse(os.path.exists(self.index))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.git_dir, 'index.lock'))
+        )
+        self.assertEqual(helpers.run_git(self.repo, 'ls-files'), '')
+
+    def test_locked_index(self):
+        open(os.path.join(self.git_dir, 'index.lock'), 'w').close()
+        self.assertRaises(
+            utils.ExecutionError, init.replace_index, self.repo, self.index
+        )
+        self.assertTrue(os.path.exists(self.index))
+        os.unlink(os.path.join(self.git_dir, 'index.lock'))
+        self.assertEqual(
+            helpers.run_git(self.repo, 'ls-files'), 'Puppetfile'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
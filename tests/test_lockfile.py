@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+
+from bade import utils
+
+
+NOVA = {'git': 'https://github.com/openstack/puppet-nova', 'ref': 'master'}
+COMMIT = '1' * 40
+TREE = '2' * 40
+
+
+class LockFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = utils.LockFile('.')
+        self.lock.set('nova', NOVA, COMMIT, TREE)
+
+    def test_get(self):
+        self.assertEqual(self.lock.get('nova', NOVA), {
+            'git': NOVA['git'], 'ref': 'master', 'commit': COMMIT,
+            'tree': TREE,
+        })
+        self.assertIsNone(self.lock.get('glance', NOVA))
+
+    def test_changed_pin_invalidates_entry(self):
+        self.assertIsNone(
+            self.lock.get('nova', dict(NOVA, ref='stable/ocata'))
+        )
+        self.assertIsNone(
+            self.lock.get('nova', dict(NOVA, git='https://example.com/nova'))
+        )
+
+    def test_resolve(self):
+        self.assertEqual(self.lock.resolve('nova', NOVA), {
+            'git': NOVA['git'], 'commit': COMMIT,
+        })
+        info = dict(NOVA, ref='stable/ocata')
+        self.assertEqual(self.lock.resolve('nova', info), info)
+
+    def test_set(self):
+        self.assertFalse(self.lock.set('nova', NOVA, COMMIT, TREE))
+        self.assertTrue(self.lock.set('nova', NOVA, '3' * 40, TREE))
+        self.assertEqual(self.lock['nova']['commit'], '3' * 40)
+
+    def test_prune(self):
+        self.lock.set('glance', dict(NOVA, git='glance'), COMMIT, TREE)
+        self.lock.prune(['glance'])
+        self.assertEqual(list(self.lock), ['glance'])
+        self.assertNotIn('nova', self.lock)
+
+    def test_round_trip(self):
+        other = utils.LockFile('.')
+        other.loads(self.lock.dumps())
+        self.assertEqual(other.get('nova', NOVA), self.lock.get('nova', NOVA))
+        self.assertEqual(
+            json.loads(self.lock.dumps())['modules']['nova']['tree'], TREE
+        )
+
+    def test_invalid_content(self):
+        self.assertRaises(utils.PuppetFileError, self.lock.loads, '{')
+
+
+if __name__ == '__main__':
+    unittest.main()
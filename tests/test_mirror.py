@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import threading
+import unittest
+
+from bade import git
+from bade import mirror
+from bade.commands import init
+from tests import helpers
+
+
+class MirrorFetchTest(helpers.RepoTestCase):
+
+    def setUp(self):
+        super(MirrorFetchTest, self).setUp()
+        source = self.make_repo('source')
+        self.upstream = os.path.join(self.tmp, 'puppet-nova.git')
+        self.mirror_dir = os.path.join(self.tmp, 'mirrors')
+        self.repo = self.make_repo()
+        self.commits = [
+            helpers.commit_file(source, 'init.pp', 'one'),
+            helpers.commit_file(source, 'init.pp', 'two'),
+        ]
+        helpers.run_git(
+            self.tmp, 'clone', '-q', '--bare', source, self.upstream
+        )
+
+    def fetch(self, commit, strategy='full'):
+        info = {'git': self.upstream, 'commit': commit}
+        init.fetch_module(
+            self.repo, 'master', 'nova', info, mirror_dir=self.mirror_dir,
+            strategy=strategy
+        )
+        return git.get_session(self.repo).resolve(
+            init.module_ref('master', 'nova')
+        )
+
+    def test_fetch_through_mirror(self):
+        self.assertEqual(self.fetch(self.commits[0]), self.commits[0])
+        path = mirror.mirror_path(self.upstream, self.mirror_dir)
+        self.assertEqual(
+            git.get_session(path).resolve('refs/heads/master'),
+            self.commits[1]
+        )
+        self.assertFalse(mirror.is_shallow(path))
+
+    def test_shallow_fetch_through_mirror(self):
+        self.assertEqual(
+            self.fetch(self.commits[0], strategy='shallow'), self.commits[0]
+        )
+        path = mirror.mirror_path(self.upstream, self.mirror_dir)
+        self.assertTrue(mirror.is_shallow(path))
+
+    def test_mirrored_commit_skips_upstream(self):
+        self.fetch(self.commits[1])
+        # upstream is not needed as long as the pin is in the mirror
+        shutil.move(self.upstream, self.upstream + '.off')
+        self.assertEqual(self.fetch(self.commits[0]), self.commits[0])
+
+    def test_concurrent_shallow_fetches_without_mirror(self):
+        modules = ['nova{0}'.format(index) for index in range(4)]
+        threads = [
+            threading.Thread(target=init.fetch_module, args=(
+                self.repo, 'master', module,
+                {'git': self.upstream, 'commit': self.commits[0]}
+            ), kwargs={'strategy': 'shallow'})
+            for module in modules
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        session = git.get_session(self.repo)
+        for module in modules:
+            self.assertEqual(
+                session.resolve(init.module_ref('master', module)),
+                self.commits[0]
+            )
+        # temporary mirrors are removed
+        self.assertEqual(
+            [name for name in os.listdir(session.git_dir())
+             if name.startswith('bade-mirror-')], []
+        )
+        self.assertTrue(
+            os.path.exists(os.path.join(session.git_dir(), 'shallow'))
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from bade import utils
+
+
+PUPPETFILE = """\
+# OpenStack modules
+forge 'https://forgeapi.puppetlabs.com'
+
+mod 'apache',
+  :git => 'https://github.com/openstack/puppet-apache',
+  :commit => '1111111111111111111111111111111111111111'
+
+mod 'nova', '1.0.0',
+    git: "https://github.com/openstack/puppet-nova",  # upstream
+    ref: 'master'
+
+mod 'mysql', :git => 'https://github.com/openstack/puppet-mysql', :commit => 'abc1234'
+"""
+
+
+class PuppetFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.puppetfile = utils.PuppetFile('.')
+        self.puppetfile.loads(PUPPETFILE)
+
+    def test_loads(self):
+        self.assertEqual(
+            self.puppetfile.keys(), ['apache', 'nova', 'mysql']
+        )
+        self.assertEqual(
+            self.puppetfile['apache']['commit'],
+            '1111111111111111111111111111111111111111'
+        )
+        self.assertEqual(
+            self.puppetfile['nova']['git'],
+            'https://github.com/openstack/puppet-nova'
+        )
+        self.assertEqual(self.puppetfile['nova']['ref'], 'master')
+        self.assertEqual(self.puppetfile['nova'].version, '1.0.0')
+        self.assertEqual(self.puppetfile['mysql']['commit'], 'abc1234')
+
+    def test_round_trip(self):
+        self.assertEqual(self.puppetfile.dumps(), PUPPETFILE)
+        other = utils.PuppetFile('.')
+        other.loads(self.puppetfile.dumps())
+        self.assertEqual(
+            [(name, module.items()) for name, module in other.items()],
+            [(name, module.items())
+             for name, module in self.puppetfile.items()]
+        )
+
+    def test_change_rewrites_only_value(self):
+        self.puppetfile['apache']['commit'] = '2' * 40
+        self.puppetfile['nova']['ref'] = 'stable/ocata'
+        self.assertEqual(
+            self.puppetfile.dumps(),
+            PUPPETFILE.replace('1' * 40, '2' * 40).replace(
+                "ref: 'master'", "ref: 'stable/ocata'"
+            )
+        )
+
+    def test_unchanged_value_keeps_layout(self):
+        self.puppetfile['nova']['git'] = (
+            'https://github.com/openstack/puppet-nova'
+        )
+        self.assertEqual(self.puppetfile.dumps(), PUPPETFILE)
+
+    def test_new_option_follows_layout(self):
+        self.puppetfile['nova']['commit'] = 'abc1234'
+        self.assertIn(
+            "    ref: 'master',\n    commit: 'abc1234'\n",
+            self.puppetfile.dumps()
+        )
+
+    def test_remove_and_add_module(self):
+        del self.puppetfile['apache']
+        self.puppetfile['keystone'] = {
+            'git': 'https://github.com/openstack/puppet-keystone',
+            'commit': 'def5678',
+        }
+        text = self.puppetfile.dumps()
+        self.assertNotIn('apache', text)
+        self.assertTrue(text.startswith(
+            "# OpenStack modules\n"
+            "forge 'https://forgeapi.puppetlabs.com'\n"
+            "\n"
+            "mod 'nova', '1.0.0',\n"
+        ))
+        self.assertTrue(text.endswith(
+            "\n\nmod 'keystone',\n"
+            "  :commit => 'def5678',\n"
+            "  :git => 'https://github.com/openstack/puppet-keystone'\n"
+        ))
+
+    def test_symbol_value(self):
+        puppetfile = utils.PuppetFile('.')
+        text = (
+            "mod 'nova',\n"
+            "  :git => 'https://github.com/openstack/puppet-nova',\n"
+            "  :ref => :master\n"
+        )
+        puppetfile.loads(text)
+        self.assertEqual(puppetfile['nova']['ref'], 'master')
+        self.assertEqual(puppetfile.dumps(), text)
+        puppetfile['nova']['ref'] = 'stable/ocata'
+        self.assertEqual(
+            puppetfile.dumps(),
+            text.replace(':master', "'stable/ocata'")
+        )
+
+    def test_syntax_error(self):
+        puppetfile = utils.PuppetFile('.')
+        self.assertRaises(
+            utils.PuppetFileError, puppetfile.loads, "mod 'nova', :git\n"
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
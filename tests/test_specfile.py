@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import os
+import shutil
+import tempfile
+import unittest
+
+from bade import utils
+
+
+SPEC = u"""\
+Name:           openstack-puppet-modules
+Version:        1.0
+Source0:        modules.tar.gz
+Patch0001:      0001-Fix-nova.patch
+Patch2: 0002-Fix-glance.patch
+
+%description
+Puppet modules — OpenStack
+
+%prep
+%setup -q
+%patch0001 -p1
+%patch2 -p1 -F2
+
+%files
+/usr/share/openstack-puppet/modules
+
+%changelog
+* Mon Jan 01 2018 Tester <tester@example.com> 1.0-1
+Patch3: 0003-Not-a-patch.patch
+%patch3 -p1
+"""
+
+
+class SpecFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        path = os.path.join(self.tmp, 'modules.spec')
+        with codecs.open(path, 'w', 'utf-8') as spec:
+            spec.write(SPEC)
+        self.spec = utils.SpecFile(path)
+        self.spec.load()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_patches(self):
+        self.assertEqual(self.spec.patches, [
+            utils.SpecPatch(
+                1, u'0001-Fix-nova.patch',
+                u'Patch0001:      0001-Fix-nova.patch\n'
+            ),
+            utils.SpecPatch(
+                2, u'0002-Fix-glance.patch',
+                u'Patch2: 0002-Fix-glance.patch\n'
+            ),
+        ])
+        self.assertEqual(
+            self.spec.patches_list,
+            u'Patch0001:      0001-Fix-nova.patch\n'
+            u'Patch2: 0002-Fix-glance.patch\n'
+        )
+
+    def test_applies(self):
+        self.assertEqual(self.spec.applies, [
+            utils.SpecApply(1, u'-p1', u'%patch0001 -p1\n'),
+            utils.SpecApply(2, u'-p1 -F2', u'%patch2 -p1 -F2\n'),
+        ])
+        self.assertEqual(
+            self.spec.patches_apply, u'%patch0001 -p1\n%patch2 -p1 -F2\n'
+        )
+
+    def test_sections(self):
+        self.assertEqual(
+            list(self.spec.sections),
+            [u'', u'description', u'prep', u'files']
+        )
+        self.assertEqual(
+            self.spec.sections[u'description'],
+            u'Puppet modules — OpenStack\n\n'
+        )
+
+    def test_changelog_is_not_parsed(self):
+        self.assertEqual(
+            self.spec.changelog,
+            u'\n* Mon Jan 01 2018 Tester <tester@example.com> 1.0-1\n'
+            u'Patch3: 0003-Not-a-patch.patch\n'
+            u'%patch3 -p1\n'
+        )
+        self.assertNotIn(3, [patch.number for patch in self.spec.patches])
+        self.assertNotIn(3, [apply.number for apply in self.spec.applies])
+
+
+if __name__ == '__main__':
+    unittest.main()
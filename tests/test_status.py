@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from StringIO import StringIO
+
+from bade import utils
+from bade.bade import Config
+from bade.commands import init
+from bade.commands import status
+from tests import helpers
+
+
+PUPPETFILE = """\
+mod 'apache',
+  :git => '{source}',
+  :commit => '{apache}'
+
+mod 'nova',
+  :git => '{source}',
+  :commit => '{nova}'
+"""
+
+
+class StatusTest(helpers.RepoTestCase):
+
+    def setUp(self):
+        super(StatusTest, self).setUp()
+        self.source = self.make_repo('source')
+        self.commits = [
+            helpers.commit_file(self.source, 'init.pp', 'one\n'),
+            helpers.commit_file(self.source, 'init.pp', 'two\n'),
+        ]
+        self.repo = self.make_repo()
+        helpers.run_git(
+            self.repo, 'fetch', '-q', self.source, '+master:refs/source'
+        )
+        utils.OUTPUT.stream = StringIO()
+
+    def tearDown(self):
+        del utils.OUTPUT.stream
+        super(StatusTest, self).tearDown()
+
+    def commit(self, modules, apache=0, nova=0):
+        """Commits Puppetfile pinning modules to given commits together
+        with directories of 'modules' {name: commit index}.
+        """
+        helpers.write_file(self.repo, 'Puppetfile', PUPPETFILE.format(
+            source=self.source, apache=self.commits[apache],
+            nova=self.commits[nova]
+        ))
+        helpers.run_git(self.repo, 'add', 'Puppetfile')
+        for module, index in sorted(modules.items()):
+            init.import_module(
+                self.repo, 'master', module, self.commits[index]
+            )
+        init.checkout_modules(self.repo, sorted(modules))
+        helpers.run_git(self.repo, 'commit', '-q', '-m', 'modules')
+
+    def status(self, worktree=False):
+        return status.command(Config(), self.repo, worktree=worktree)
+
+    def test_matching_modules(self):
+        self.commit({'apache': 0, 'nova': 1}, nova=1)
+        self.assertEqual(self.status(worktree=True), [])
+
+    def test_drifted(self):
+        self.commit({'apache': 0, 'nova': 0}, nova=1)
+        self.assertEqual(self.status(), [('nova', 'drifted')])
+        self.assertIn(
+            '[warning] nova: drifted', utils.OUTPUT.stream.getvalue()
+        )
+
+    def test_missing(self):
+        self.commit({'apache': 0})
+        self.assertEqual(self.status(), [('nova', 'missing')])
+
+    def test_modified(self):
+        self.commit({'apache': 0, 'nova': 0})
+        helpers.write_file(self.repo, 'nova/init.pp', 'local\n')
+        self.assertEqual(self.status(), [])
+        self.assertEqual(
+            self.status(worktree=True), [('nova', 'modified')]
+        )
+
+    def test_orphaned(self):
+        self.commit({'apache': 0, 'nova': 0, 'glance': 0})
+        helpers.run_git(
+            self.repo, 'update-ref', init.module_ref('master', 'glance'),
+            self.commits[0]
+        )
+        self.assertEqual(self.status(), [('glance', 'orphaned')])
+
+    def test_unresolved(self):
+        self.commit({'apache': 0, 'nova': 0})
+        puppetfile = utils.PuppetFile(self.repo)
+        puppetfile.load()
+        puppetfile['nova']['commit'] = '3' * 40
+        puppetfile.save()
+        self.assertEqual(self.status(), [('nova', 'unresolved')])
+
+
+if __name__ == '__main__':
+    unittest.main()